@@ -15,17 +15,24 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import argparse
+import collections
+import concurrent.futures
+import functools
+import gc
+import logging
 import os
 import re
-import optparse
-from optparse import OptionParser
 import glob
+import sys
 
-import circuit
-import circuit_writer
-import spice
-import spice_analyser
-from design import Design
+# Ask for protobuf's native upb runtime unless the user chose an
+# implementation. This has to happen before protobuf is first imported (by
+# spice_analyser or circuit_writer); upb is already the default for protobuf
+# >= 4.21 wheels, but not necessarily for other builds.
+os.environ.setdefault('PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION', 'upb')
+
+log = logging.getLogger(__name__)
 
 
 def PrefixRelativeName(prefix, name):
@@ -35,9 +42,27 @@ def PrefixRelativeName(prefix, name):
 
 
 def FilesExistOrError(file_names):
+  # Inputs tend to come from a few directories, so list each of those once
+  # instead of stat-ing every file.
+  by_directory = collections.defaultdict(list)
   for file_name in file_names:
-    if not os.path.exists(file_name):
-      raise IOError(f'File not found: {file_name}')
+    by_directory[os.path.dirname(file_name) or '.'].append(file_name)
+
+  for directory, names in by_directory.items():
+    entries = {}
+    if len(names) > 1:
+      try:
+        with os.scandir(directory) as it:
+          entries = {entry.name: entry for entry in it}
+      except OSError:
+        pass
+    for file_name in names:
+      entry = entries.get(os.path.basename(file_name))
+      # Symlinks might dangle, so those still need following.
+      if entry is not None and not entry.is_symlink():
+        continue
+      if not os.path.exists(file_name):
+        raise IOError(f'File not found: {file_name}')
 
 
 def RequireOptions(options, *argv):
@@ -48,64 +73,109 @@ def RequireOptions(options, *argv):
           ', '.join(argv))
 
 
-def DefineOptions(optparser):
-  optparser.add_option('-t', '--top', dest='top_name', default=None, help='top module')
-  optparser.add_option('--verilog', dest='verilog_files', default=[], action='append', help='verilog files')
-  optparser.add_option('--verilog_include', dest='verilog_includes', default=[], action='append', help='verilog include paths')
-  optparser.add_option('--verilog_defines', dest='verilog_defines', default=[], action='append', help='verilog macro definitions')
-  optparser.add_option('--spef', dest='spef_files', default=[], action='append', help='spef files')
+# Bus delimiter: []. Only a trailing index counts; the greedy prefix means
+# 'a[1][2]' splits at the last index.
+BUS_INDEX_RE = re.compile(r'(.*)\[(\d+)\]\Z')
+
+
+# Supply nets at which searches through the netlist stop.
+PATH_IGNORE_SIGNALS = frozenset(('VGND', 'VPWR'))
+MODULE_TEST_IGNORE_SIGNALS = frozenset(('GND', 'VSS', 'VDD'))
+
+
+@functools.lru_cache(maxsize=None)
+def SplitBusIndex(text):
+  # s0[0] -> (s0, 0)
+  # s0 -> (s0, None)
+  # None -> None
+  if text is None:
+    return None
+  # Names are interned to match the port names in the design, so that looking
+  # them up compares pointers rather than characters.
+  match = BUS_INDEX_RE.match(text)
+  if match is None:
+    return sys.intern(text), None
+  return sys.intern(match.group(1)), match.group(2)
+
+
+def DefineOptions(parser):
+  parser.add_argument('-t', '--top', dest='top_name', default=None, help='top module')
+  parser.add_argument('--verilog', dest='verilog_files', default=[], action='append', help='verilog files')
+  parser.add_argument('--verilog_include', dest='verilog_includes', default=[], action='append', help='verilog include paths')
+  parser.add_argument('--verilog_defines', dest='verilog_defines', default=[], action='append', help='verilog macro definitions')
+  parser.add_argument('--yosys_verilog_reader', dest='yosys_verilog_reader', default=False, action='store_true', help='read verilog with yosys instead of pyverilog; faster on big netlists, but experimental: positional instance ports, assign statements, constant or concatenated connections and bus offsets are not supported')
+  parser.add_argument('--ast_cache_dir', dest='ast_cache_dir', default=None, action='store', help='cache parsed verilog in this directory, keyed by file contents')
+  parser.add_argument('--verilog_jobs', dest='verilog_jobs', default=1, type=int, action='store', help='number of processes used to build modules from parsed verilog')
+  parser.add_argument('--spef', dest='spef_files', default=[], action='append', help='spef files')
+  parser.add_argument('--spef_jobs', dest='spef_jobs', default=1, type=int, action='store', help='number of processes used to read SPEF files')
   
   # FIXME: what is the difference between these two "spice" options? 
-  optparser.add_option('--spice', dest='spice_files', default=[], action='append', help='read spice file contents. Subcircuits are read to circuit.Modules')
-  optparser.add_option('--spice_header', dest='spice_header_files', default=[], action='append', help='read spice file headers. Subcircuits are read for port order and stored as ExternalModules')
+  parser.add_argument('--spice', dest='spice_files', default=[], action='append', help='read spice file contents. Subcircuits are read to circuit.Modules')
+  parser.add_argument('--spice_header', dest='spice_header_files', default=[], action='append', help='read spice file headers. Subcircuits are read for port order and stored as ExternalModules')
 
-  optparser.add_option('-s', '--dump_spice', dest='dump_spice', default=None, action='store', help='big spice file to write out')
-  optparser.add_option('--test_manifest', dest='test_manifest', default=None, action='store', help='read this test manifest and try to find and add the results')
-  optparser.add_option('--test_analysis', dest='test_analysis', default=None, action='store', help='read this analysis proto and try to find and add the results')
+  parser.add_argument('-s', '--dump_spice', dest='dump_spice', default=None, action='store', help='big spice file to write out')
+  parser.add_argument('--test_manifest', dest='test_manifest', default=None, action='store', help='read this test manifest and try to find and add the results')
+  parser.add_argument('--test_analysis', dest='test_analysis', default=None, action='store', help='read this analysis proto and try to find and add the results')
 
-  optparser.add_option('-f', '--flatten_spice', dest='flatten_spice', default=False, action='store_true', help='flatten spice decks as much as possible')
-  optparser.add_option('-d', '--working_dir', dest='working_dir', default=None, action='store', help='prefix directory to output all files')
+  parser.add_argument('-f', '--flatten_spice', dest='flatten_spice', default=False, action='store_true', help='flatten spice decks as much as possible')
+  parser.add_argument('-d', '--working_dir', dest='working_dir', default=None, action='store', help='prefix directory to output all files')
 
-  optparser.add_option('--delays_csv', dest='delays_csv', default=None, action='store', help='write CSV of measured delays')
-  optparser.add_option('--input_caps_csv', dest='input_caps_csv', default='input_caps.csv', action='store', help='write CSV of measured delays')
+  parser.add_argument('--delays_csv', dest='delays_csv', default=None, action='store', help='write CSV of measured delays')
+  parser.add_argument('--input_caps_csv', dest='input_caps_csv', default='input_caps.csv', action='store', help='write CSV of measured delays')
 
   # TODO(growly): Helper options.
-  optparser.add_option('--import', dest='import_circuit', default=False, action='store_true', help='import a circuit from verilog, SPEF, spice, etc')
-  optparser.add_option('--load', dest='load', default=None, action='store', help='read circuit proto containing netlist')
-  optparser.add_option('--save', dest='save', default=None, action='store', help='write circuit proto containing final netlist to this file')
-  optparser.add_option('--show', dest='show_design', default=False, action='store_true', help='print summary of loaded design')
-
-  optparser.add_option('--from_port', dest='from_port', default=None, action='store', help='dump passively-connected path from this port (requires --to_port)')
-  optparser.add_option('--to_port', dest='to_port', default=None, action='store', help='dump passively-connected path to this port (requires --from_port)')
-
-  optparser.add_option('--generate_input_capacitance_tests',
-                       dest='generate_input_capacitance_tests',
-                       default=False,
-                       action='store_true',
-                       help='generate spice tests for external module input capacitances')
-  optparser.add_option('--analyze_input_capacitance_tests',
-                       dest='analyze_input_capacitance_tests',
-                       default=False,
-                       action='store_true',
-                       help='')
-
-  optparser.add_option('--generate_module_tests',
-                       dest='generate_module_tests',
-                       default=False,
-                       action='store_true',
-                       help='')
+  parser.add_argument('--import', dest='import_circuit', default=False, action='store_true', help='import a circuit from verilog, SPEF, spice, etc')
+  parser.add_argument('--load', dest='load', default=None, action='store', help='read circuit proto containing netlist')
+  parser.add_argument('--load_cache_dir', dest='load_cache_dir', default=None, action='store', help='cache designs read with --load in this directory, keyed by file path, size and modification time')
+  parser.add_argument('--save', dest='save', default=None, action='store', help='write circuit proto containing final netlist to this file')
+  parser.add_argument('--no_text_proto', dest='save_text_proto', default=True, action='store_false', help='with --save, skip the (much slower) text-format copy of the circuit proto')
+  parser.add_argument('--show', dest='show_design', default=False, action='store_true', help='print summary of loaded design')
+  parser.add_argument('-v', '--verbose', dest='verbose', default=False, action='store_true', help='log detailed progress, e.g. every signal and instance merged from SPEF')
+  parser.add_argument('-q', '--quiet', dest='quiet', default=False, action='store_true', help='only log warnings and errors')
+
+  parser.add_argument('--from_port', dest='from_port', default=None, action='store', help='dump passively-connected path from this port (requires --to_port)')
+  parser.add_argument('--to_port', dest='to_port', default=None, action='store', help='dump passively-connected path to this port (requires --from_port)')
+
+  parser.add_argument('--generate_input_capacitance_tests',
+                      dest='generate_input_capacitance_tests',
+                      default=False,
+                      action='store_true',
+                      help='generate spice tests for external module input capacitances')
+  parser.add_argument('--analyze_input_capacitance_tests',
+                      dest='analyze_input_capacitance_tests',
+                      default=False,
+                      action='store_true',
+                      help='')
+
+  parser.add_argument('--generate_module_tests',
+                      dest='generate_module_tests',
+                      default=False,
+                      action='store_true',
+                      help='')
   # TODO(growly): Normalize to incorrect English spelling.
-  optparser.add_option('--analyze_module_tests',
-                       dest='analyze_module_tests',
-                       default=False,
-                       action='store_true',
-                       help='')
+  parser.add_argument('--analyze_module_tests',
+                      dest='analyze_module_tests',
+                      default=False,
+                      action='store_true',
+                      help='')
 
 
 def GlobAndFlatten(files):
+  # Literal paths glob to themselves (or to nothing, in which case we keep
+  # them anyway), so only expand real patterns. Those are bound by filesystem
+  # latency, so expand them concurrently.
+  patterns = [spec for spec in files if glob.has_magic(spec)]
+  matches = {}
+  if len(patterns) > 1:
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(32, len(patterns))) as executor:
+      matches = dict(zip(patterns, executor.map(glob.glob, patterns)))
+  elif patterns:
+    matches = {patterns[0]: glob.glob(patterns[0])}
+
   flattened = []
   for spec in files:
-    matched = glob.glob(spec)
+    matched = matches.get(spec)
     if not matched:
       flattened.append(spec)
       continue
@@ -114,26 +184,37 @@ def GlobAndFlatten(files):
 
 
 def Main():
-  optparser = OptionParser()
-  DefineOptions(optparser)
-  options, args = optparser.parse_args()
+  parser = argparse.ArgumentParser()
+  DefineOptions(parser)
+  options = parser.parse_args()
   return WithOptions(options)
 
 
-def WithOptions(options: optparse.Values):
+def WithOptions(options: argparse.Namespace):
+  # These pull in numpy, so defer them until there's work to do; --help and
+  # bad invocations shouldn't pay for them.
+  import circuit
+  import spice
+  from design import Design
+
+  logging.basicConfig(
+      format='%(message)s',
+      level=(logging.DEBUG if options.verbose else
+             logging.WARNING if options.quiet else logging.INFO))
 
   # Make any output directories necessary.
-  output_directory = options.working_dir or '.'
-  if not os.path.exists(output_directory):
-    os.makedirs(output_directory)
-  output_directory = os.path.abspath(output_directory)
+  output_directory = os.path.abspath(options.working_dir or '.')
+  os.makedirs(output_directory, exist_ok=True)
 
   # Check that input files exist.
   verilog_files = GlobAndFlatten(options.verilog_files)
   spef_files = GlobAndFlatten(options.spef_files)
   spice_headers = GlobAndFlatten(options.spice_header_files)
   spice_files = GlobAndFlatten(options.spice_files)
-  file_names = options.verilog_files + options.spef_files + spice_headers + spice_files
+  # Overlapping patterns can name the same file more than once; only check it
+  # once (dict keeps the order, for stable error messages).
+  file_names = list(dict.fromkeys(
+      (*verilog_files, *spef_files, *spice_headers, *spice_files)))
 
   if options.test_manifest is not None:
     file_names.append(options.test_manifest)
@@ -144,33 +225,57 @@ def WithOptions(options: optparse.Values):
 
   FilesExistOrError(file_names)
 
-  spice_libs = [os.path.abspath(path) for path in spice_headers]
+  # This is what os.path.abspath does, but without a getcwd() per header.
+  cwd = os.getcwd()
+  spice_libs = [os.path.normpath(os.path.join(cwd, path))
+                for path in spice_headers]
 
   design = Design()
 
-  if options.load:
-    # Read an existing circuit description (netlist) from disk.
-    reader = circuit_writer.CircuitWriter(design)
-    reader.ReadProtoToDesign(options.load)
-  elif options.import_circuit:
-    if spice_headers:
-      design.ParseSpiceDefinitions(spice_headers, headers_only=True)
-
-    if spice_files:
-      design.ParseSpiceDefinitions(spice_files, headers_only=False)
-
-    # TODO(growly): It would be nice to be able to add information from verilog,
-    # SPEF, spice, etc, files to an existing circuit description. By which I mean,
-    # it would be nice to be sure that works.
-    if verilog_files:
-      design.ParseVerilog(verilog_files, options.verilog_includes, options.verilog_defines)
-
-    if spef_files:
-      design.ParseSPEF(spef_files)
-
-    # Turn references to modules by name into references by pointer.
-    design.Link()
-    design.CheckPowerAndGround()
+  # Loading a design allocates a huge number of long-lived objects, so the
+  # cyclic garbage collector's repeated passes over them are wasted. Keep it off
+  # while loading. Afterwards, one collection reclaims what was discarded (e.g.
+  # the SPEF modules merged into the netlist) and the survivors are frozen out
+  # of later collections.
+  gc.disable()
+  try:
+    if options.load:
+      # Read an existing circuit description (netlist) from disk.
+      import circuit_writer
+      reader = circuit_writer.CircuitWriter(design)
+      reader.ReadProtoToDesign(options.load,
+                               cache_dir=options.load_cache_dir)
+    elif options.import_circuit:
+      # Start reading SPEF (in worker processes, with --spef_jobs) while the
+      # other inputs are read. It's merged last, once the modules it annotates
+      # are known.
+      with design.SPEFReaders(
+          spef_files, jobs=options.spef_jobs) as spef_readers:
+        if spice_headers:
+          design.ParseSpiceDefinitions(spice_headers, headers_only=True)
+
+        if spice_files:
+          design.ParseSpiceDefinitions(spice_files, headers_only=False)
+
+        # TODO(growly): It would be nice to be able to add information from verilog,
+        # SPEF, spice, etc, files to an existing circuit description. By which I mean,
+        # it would be nice to be sure that works.
+        if verilog_files:
+          design.ParseVerilog(verilog_files, options.verilog_includes,
+                              options.verilog_defines,
+                              use_yosys=options.yosys_verilog_reader,
+                              cache_dir=options.ast_cache_dir,
+                              jobs=options.verilog_jobs)
+
+        design.AddSPEFReaders(spef_readers)
+
+      # Turn references to modules by name into references by pointer.
+      design.Link()
+      design.CheckPowerAndGround()
+  finally:
+    gc.enable()
+    gc.collect()
+    gc.freeze()
 
   if options.show_design:
     design.Show()
@@ -179,56 +284,51 @@ def WithOptions(options: optparse.Values):
   if options.top_name:
     top = design.FindTop(options.top_name)
     if top is None:
-      raise Exception(f'top not found: {options.top_name}')
-      sys.exit(1)
+      sys.exit(f'error: top not found: {options.top_name}')
 
-  analyser = spice_analyser.SpiceAnalyser(design, output_directory, spice_libs)
+  # The analyser pulls in numpy and matplotlib, so only create it for the
+  # options that use it.
+  @functools.lru_cache(maxsize=None)
+  def Analyser():
+    import spice_analyser
+    return spice_analyser.SpiceAnalyser(design, output_directory, spice_libs)
+
+  # Likewise, one writer serves both --dump_spice and region extraction.
+  @functools.lru_cache(maxsize=None)
+  def SpiceWriter():
+    return spice.SpiceWriter(design, flatten=options.flatten_spice)
 
   if options.generate_input_capacitance_tests:
+    analyser = Analyser()
     analyser.AddInputCapacitanceTestsForKnownModules(used_by_module=top)
     analyser.AddInputCapacitanceTestsForExternalModules(used_by_module=top)
     analyser.WriteMetadata(options.test_manifest, options.test_analysis)
 
   if options.analyze_input_capacitance_tests:
     RequireOptions(options, 'test_manifest', 'test_analysis')
+    analyser = Analyser()
     # Read results from a spice run.
     analyser.FindInputCapacitances(options.test_manifest, options.test_analysis)
     csv_file = PrefixRelativeName(
         output_directory, options.input_caps_csv) if options.input_caps_csv else None
     analyser.DumpInputCapacitances(csv_file)
 
-  def SplitBusIndex(text):
-    # s0[0] -> (s0, 0)
-    # s0 -> (s0, None)
-    # None -> None
-    if text is None:
-      return None
-    # Bus delimiter: []
-    match = re.match(r'(.*)\[(\d+)\]', text)
-    if match is None:
-      return text, None
-    return match.group(1), match.group(2)
-
   # TODO(growly): Need to generalise VerilogIdentifier into something that can
   # specify a bus index, width, etc, then use that as the argument here
   # to allow users to specific bus pins as ports.
   if options.from_port and options.to_port:
-    ignore_signals = set(['VGND', 'VPWR'])
-    from_port, from_index = SplitBusIndex(options.from_port)
-    if from_port in top.ports:
-      start_port = top.ports[from_port]
-    else:
-      raise Exception(f'port not found in {top.name}: {from_port}')
-      sys.exit(1)
-    from_index = int(from_index) if from_index is not None else 0
+    ignore_signals = PATH_IGNORE_SIGNALS
 
-    to_port, to_index = SplitBusIndex(options.to_port)
-    if to_port in top.ports:
-      stop_port = top.ports[to_port]
-    else:
-      raise Exception(f'port not found in {top.name}: {to_port}')
-      sys.exit(1)
-    to_index = int(to_index) if to_index is not None else 0
+    def FindPortOrExit(text):
+      # 'a[3]' -> (port a, 3); 'a' -> (port a, 0)
+      port_name, index = SplitBusIndex(text)
+      port = top.ports.get(port_name)
+      if port is None:
+        sys.exit(f'error: port not found in {top.name}: {port_name}')
+      return port, int(index) if index is not None else 0
+
+    start_port, from_index = FindPortOrExit(options.from_port)
+    stop_port, to_index = FindPortOrExit(options.to_port)
 
     region = circuit.Module.FindConnectedRegionBetweenPorts(
         start_port, stop_port,
@@ -242,23 +342,21 @@ def WithOptions(options: optparse.Values):
     file_name = f'{region.name}.sp'
     full_path = os.path.join(output_directory, file_name)
 
-    spice_writer = spice.SpiceWriter(design, flatten=options.flatten_spice)
+    spice_writer = SpiceWriter()
     spice_writer.WriteRegion(full_path, region)
 
   if options.generate_module_tests:
+    analyser = Analyser()
     # TODO(growly): Move within SpiceAnalyser.
     # Find a reasonable seed wire for the search.
     #ignore_signals = set(self.design.power_net_names + self.design.ground_net_names)
-    ignore_signals = set(['GND', 'VSS', 'VDD'])
-    seed = None
-    for port in top.ports.values():
-      if port.signal in ignore_signals:
-        continue
-      seed = circuit.Wire(port.signal, 0)
-    assert(seed is not None)
+    ignore_signals = MODULE_TEST_IGNORE_SIGNALS
+    seed_port = next((port for port in top.ports.values()
+                      if port.signal.name not in ignore_signals), None)
+    assert(seed_port is not None)
+    seed = circuit.Wire(seed_port.signal, 0)
 
     #seed = circuit.Wire(top.ports['a'].signal, 0)
-    seed = circuit.Wire(list(top.ports.values())[0].signal, 0)
 
     analyser.LoadRegionList(
         circuit.Module.ExtractPassiveRegions(seed, ignore_signals))
@@ -270,6 +368,7 @@ def WithOptions(options: optparse.Values):
 
   if options.analyze_module_tests:
     RequireOptions(options, 'test_manifest', 'test_analysis')
+    analyser = Analyser()
     csv_file = PrefixRelativeName(
         output_directory, options.delays_csv) if options.delays_csv else None
     analyser.AnalyseModuleTests(
@@ -278,16 +377,20 @@ def WithOptions(options: optparse.Values):
         csv_file)
 
   if options.save is not None:
+    import circuit_writer
     writer = circuit_writer.CircuitWriter(design)
     save_file = PrefixRelativeName(output_directory, options.save)
-    writer.WriteDesignToProto(save_file)
-    writer.WriteDesignToTextProto(save_file + '.txt')
+    # Both writers stream the proto a module at a time.
+    if options.save_text_proto:
+      writer.WriteDesignToProtoAndTextProto(save_file, save_file + '.txt')
+    else:
+      writer.WriteDesignToProto(save_file)
 
   if options.dump_spice is not None:
-    spice_writer = spice.SpiceWriter(design, flatten=options.flatten_spice)
+    spice_writer = SpiceWriter()
     spice_file = PrefixRelativeName(output_directory, options.dump_spice)
     spice_writer.WriteTop(spice_file)
-    print(f'wrote top module ({top.name}) spice module: {spice_file}')
+    log.info('wrote top module (%s) spice module: %s', top.name, spice_file)
 
 
 
@@ -14,17 +14,18 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-import pdb
 import math
 from enum import Enum
 import collections
-
-
-import pdb
+import functools
+import logging
+import sys
 
 import spice
 from spice_util import NumericalValue, SIUnitPrefix
 
+log = logging.getLogger(__name__)
+
 
 # Modules describe a cell's structure. They are a template for instantiation of
 # the module (cell) in other modules (cells). A design is at its root a module
@@ -59,6 +60,18 @@ RESISTOR = None
 INDUCTOR = None
 PRIMITIVE_MODULES = {}
 
+# Coupling capacitances below this value are considered boundaries for passive
+# subgraphs.
+COUPLING_CAP_LIMIT = NumericalValue(100, SIUnitPrefix.ATTO)
+# The same limit expressed in each unit prefix, so that checking a
+# capacitance against it is one float comparison.
+COUPLING_CAP_LIMIT_BY_UNIT = {
+    unit: COUPLING_CAP_LIMIT._InOtherUnits(unit).value
+    for unit in (None, *SIUnitPrefix)}
+
+# What Signal.Connects returns for an index with no connections.
+NO_CONNECTS = frozenset()
+
 
 # TODO(growly): Need a 'Parameter' class to wrap generic parameter values
 # and enable appropriate actions for their type.
@@ -71,10 +84,13 @@ class Port:
     INOUT = 3
     NONE = 4
 
+  __slots__ = ('name', 'signal', 'direction', 'capacitance')
+
   def __repr__(self):
     return '[port: {} {}]'.format(self.signal, self.direction)
 
   def __init__(self):
+    self.name = None
     # This is the internal signal which represents this port/pin. External
     # signals connected to this one use a Connection object.
     self.signal = None
@@ -92,11 +108,14 @@ class Port:
       return None
     signal = self.signal
     low = max(0, low) if low is not None else 0
-    high = min(signal.width, high) if high is not None else signal.Width
+    high = min(signal.width, high) if high is not None else signal.width
     return [Wire(signal, i) for i in range(low, high)]
 
 
 class Signal:
+  __slots__ = ('name', 'width', 'ports', 'connects', 'num_connects',
+               'parent_name')
+
   def __init__(self, name, width=1):
     self.name = name
     self.width = width
@@ -107,7 +126,12 @@ class Signal:
     # any slice of the Signal implicitly connects each of those wires. Therefore
     # slices can remain lightweight and be duplicated as a bookkeeping measure
     # where needed.
-    self.connects = collections.defaultdict(set)
+    #
+    # This maps index -> set of entities. Indices with no connections have no
+    # entry (and no empty set); read them with Connects(index).
+    self.connects = {}
+    # The total number of entries in connects, over all indices.
+    self.num_connects = 0
 
     # If this signal is known to probably replace some signal in a previous
     # version of the circuit, include the name of that signal here:
@@ -118,29 +142,34 @@ class Signal:
     return out
 
   def Connect(self, to, index=None):
-    if index is None:
-      # If no index is given, connect to all indices.
-      for i in range(self.width):
-        self.connects[i].add(to)
-      return
-    self.connects[index].add(to)
+    # If no index is given, connect to all indices.
+    self.ConnectIndices(to, range(self.width) if index is None else (index,))
+
+  def ConnectIndices(self, to, indices):
+    for i in indices:
+      connects = self.connects.get(i)
+      if connects is None:
+        self.connects[i] = {to}
+        self.num_connects += 1
+      elif to not in connects:
+        connects.add(to)
+        self.num_connects += 1
 
   def Connects(self, index=None):
+    # The set returned for a single index must not be modified.
     if index is not None:
-      return self.connects[index]
+      return self.connects.get(index, NO_CONNECTS)
 
     union = set()
+    if not self.num_connects:
+      return union
     for k in range(self.width):
-      union.update(self.connects[k])
+      union.update(self.connects.get(k, NO_CONNECTS))
     return union
 
+  @property
   def ConnectsAnything(self):
-    if not self.connects:
-      return False
-    for index, connects in self.connects.items():
-      if connects:
-        return True
-    return False
+    return self.num_connects > 0
 
   def FindLoadPorts(self, index=None):
     connects = self.Connects(index=index)
@@ -154,7 +183,10 @@ class Signal:
       if isinstance(connected, Connection) and (
           connected.DirectionOfInstancePort() == Port.Direction.INPUT):
         module = connected.instance.module
-        port = module.ports[connected.port_name]
+        port = module.ports.get(connected.port_name)
+        if port is None:
+          # The direction was only guessed; there's no port to report.
+          continue
         load_ports.add((connected.port_name, module, port))
     return load_ports
 
@@ -165,12 +197,15 @@ class Signal:
   def DisconnectEntity(self, index, entity):
     connects = self.connects[index]
     connects.remove(entity)
+    if not connects:
+      del self.connects[index]
+    self.num_connects -= 1
     #print(f'removed {entity} from {index} {self}')
     if isinstance(entity, Connection) or isinstance(entity, Port):
       entity.DisconnectFromSignal()
 
   def DisconnectIndex(self, index, entity=None, include_ports=False):
-    for connected in list(self.connects[index]):
+    for connected in list(self.Connects(index)):
       if not include_ports and isinstance(connected, Port):
         continue
       if entity is not None:
@@ -189,13 +224,24 @@ class Wire:
   """A Signal reference with a single index, always width-1.
 
   Use as a (signal, index) pair for keys, too."""
+  # Wires are immutable and mostly made to be put in sets, so the hash is
+  # computed once.
+  __slots__ = ('signal', 'index', '_hash', '_spice_name')
 
   def __init__(self, signal, index):
     self.signal = signal
     self.index = index
+    self._hash = hash((signal, index))
+    # Cached by SpiceName.
+    self._spice_name = None
+
+  def __reduce__(self):
+    # The hash depends on the identity of the signal, so it must be recomputed
+    # rather than copied.
+    return Wire, (self.signal, self.index)
 
   def __hash__(self):
-    return hash((self.signal, self.index))
+    return self._hash
 
   def __eq__(self, other):
     return self.signal == other.signal and self.index == other.index
@@ -204,9 +250,7 @@ class Wire:
     return f'[wire {self.signal.name}[{self.index}]]'
 
   def __lt__(self, other):
-    if self.signal.name < other.signal.name:
-      return True
-    return self.index < other.index
+    return (self.signal.name, self.index) < (other.signal.name, other.index)
 
   def Connects(self):
     if not self.signal or self.index is None:
@@ -214,10 +258,12 @@ class Wire:
     return self.signal.Connects(self.index)
 
   def SpiceName(self):
-    if self.signal.width == 1:
-      return self.signal.name
-    else:
-      return f'{self.signal.name}.{self.index}'
+    if self._spice_name is None:
+      if self.signal.width == 1:
+        self._spice_name = self.signal.name
+      else:
+        self._spice_name = f'{self.signal.name}.{self.index}'
+    return self._spice_name
 
 
 class Connection:
@@ -228,12 +274,18 @@ class Connection:
   width. If a Concatenation is connected, the total width of that
   Concatenation must match.
   """
+  # There is one of these per instance port, so keep them small.
+  __slots__ = ('port_name', 'instance', 'signal', 'slice', 'concat',
+               'direction')
+
   def __init__(self, port_name):
     self.port_name = port_name
     self.instance = None
     self.signal = None
     self.slice = None
     self.concat = None
+    # Cached by DirectionOfInstancePort.
+    self.direction = None
 
   def __repr__(self):
     #desc = 'connection {} <-> '.format(self.port_name)
@@ -255,9 +307,8 @@ class Connection:
 
   def EnumerateWires(self):
     signal = self.GetConnectedSignal()
-    indices = self.IndexOnSignal()
-    return [Wire(signal, k + indices[0])
-            for k in range(indices[1] - indices[0] + 1)]
+    high, low = self.IndexOnSignal()
+    return [Wire(signal, k) for k in range(low, high + 1)]
 
   def IndexOnSignal(self):
     # Returns a pair of [hi, low] indices to which this Connection
@@ -269,11 +320,17 @@ class Connection:
     raise NotImplementedError()
 
   def DirectionOfInstancePort(self):
+    # Graph searches ask for this on every hop, so it is looked up once. That
+    # only happens after the design is linked, so the module won't change.
+    if self.direction is not None:
+      return self.direction
     if (type(self.instance.module) is ExternalModule and
         self.port_name not in self.instance.module.ports):
-      return ExternalModule.GuessDirectionOfExternalModulePort(self.port_name)
-
-    return self.instance.module.ports[self.port_name].direction
+      self.direction = ExternalModule.GuessDirectionOfExternalModulePort(
+          self.port_name)
+    else:
+      self.direction = self.instance.module.ports[self.port_name].direction
+    return self.direction
 
   def GetConnected(self):
     if self.signal is not None:
@@ -296,6 +353,7 @@ class Connection:
     assert self.port_name in self.instance.connections, f'{self.port_name} not in {self.instance.connections}'
     self.DisconnectFromSignal()
     del self.instance.connections[self.port_name]
+    self.instance.outgoing_connections = None
 
   def DisconnectFromSignal(self):
     self.signal = None
@@ -310,6 +368,7 @@ class Connection:
 
 
 class Slice: 
+  __slots__ = ('signal', 'top', 'bottom')
 
   def __init__(self):
     self.signal = None
@@ -322,25 +381,21 @@ class Slice:
   def Connect(self, to, index=None):
     if index is None:
       # If no index is given, connect to all indices.
-      for i in range(self.top - self.bottom + 1):
-        index = i + self.bottom
-        self.signal.Connect(to, index=index)
+      self.signal.ConnectIndices(to, range(self.bottom, self.top + 1))
       return
     elif index < self.bottom or index > self.top:
       raise IndexError(f'slice does not include index {index}')
     self.signal.Connect(to, index=index)
 
   def Disconnect(self, entity, include_ports=False):
-    for i in range(self.top - self.bottom + 1):
-      index = i + self.bottom
-      self.signal.DisconnectIndex(index, entity=entity, include_ports=include_ports)
+    signal = self.signal
+    for index in range(self.bottom, self.top + 1):
+      signal.DisconnectIndex(index, entity=entity, include_ports=include_ports)
 
   def Connects(self):
-    connects = set()
-    for i in range(self.top - self.bottom + 1):
-      k = i + self.bottom
-      connects.update(self.signal.connects[k])
-    return connects
+    connects = self.signal.connects
+    return set().union(*(connects.get(k, NO_CONNECTS)
+                         for k in range(self.bottom, self.top + 1)))
 
   def Width(self):
     return self.top - self.bottom + 1
@@ -366,6 +421,8 @@ class Slice:
 
 
 class Instance:
+  __slots__ = ('name', 'module_name', 'module', 'parameters', 'connections',
+               'connections_by_order', 'outgoing_connections')
 
   def __init__(self):
     self.name = None
@@ -379,14 +436,29 @@ class Instance:
     # a spice deck not having loaded the master modules.
     self.connections_by_order = []
 
+    # Cached by OutgoingConnections. Whatever changes 'connections' once the
+    # design is linked has to reset this to None.
+    self.outgoing_connections = None
+
+  def OutgoingConnections(self):
+    # The connections to OUTPUT and INOUT ports, which path searches follow
+    # out of the instance.
+    if self.outgoing_connections is None:
+      self.outgoing_connections = [
+          connection for connection in self.connections.values()
+          if connection.DirectionOfInstancePort() in (
+              Port.Direction.OUTPUT, Port.Direction.INOUT)]
+    return self.outgoing_connections
+
   def __repr__(self):
-    conn_list = []
-    port_order = (self.module.port_order
-        if self.module is not None else sorted(self.connections.keys()))
-    for port_name in port_order:
-      if port_name in self.connections:
-        connection = self.connections[port_name]
-        conn_list.append(f'{port_name}: {connection}')
+    if self.module is not None:
+      connections = ((port_name, self.connections[port_name])
+                     for port_name in self.module.port_order
+                     if port_name in self.connections)
+    else:
+      connections = sorted(self.connections.items())
+    conn_list = [f'{port_name}: {connection}'
+                 for port_name, connection in connections]
     return '[instance {} of {}, params={} connections={}]'.format(
         self.name,
         self.module_name,
@@ -395,10 +467,15 @@ class Instance:
 
 
 class TwoEndedElement(Instance):
+  __slots__ = ()
 
   def __init__(self, left, right):
     super().__init__()
-    for port_name, to_connect in zip(('A', 'B'), (left, right)):
+    # Extracted netlists hold very many of these. They are always connected
+    # by name, so share one empty connections_by_order rather than allocate a
+    # list each.
+    self.connections_by_order = ()
+    for port_name, to_connect in (('A', left), ('B', right)):
       connection = Connection(port_name)
       connection.instance = self
       self.connections[port_name] = connection
@@ -410,6 +487,7 @@ class TwoEndedElement(Instance):
 
 
 class Capacitor(TwoEndedElement):
+  __slots__ = ()
 
   def __init__(self, left_signal, right_signal, value):
     super().__init__(left_signal, right_signal)
@@ -419,6 +497,7 @@ class Capacitor(TwoEndedElement):
 
 
 class Resistor(TwoEndedElement):
+  __slots__ = ()
 
   def __init__(self, left_signal, right_signal, value):
     super().__init__(left_signal, right_signal)
@@ -428,6 +507,7 @@ class Resistor(TwoEndedElement):
 
 
 class Inductor(TwoEndedElement):
+  __slots__ = ()
 
   def __init__(self, left_signal, right_signal, value):
     super().__init__(left_signal, right_signal)
@@ -436,6 +516,20 @@ class Inductor(TwoEndedElement):
     self.parameters['inductance'] = value
 
 
+# Port directions assumed by ExternalModule.GuessDirectionOfExternalModulePort
+# for cells whose models we couldn't read. Anything else is an INPUT.
+GUESSED_PORT_DIRECTIONS = {
+    **dict.fromkeys(('d', 'g', 's', 'b'), Port.Direction.NONE),
+    **dict.fromkeys(('VDD', 'VSS', 'VPWR', 'VGND'), Port.Direction.INOUT),
+    # ASAP7:
+    #**dict.fromkeys(('Y', 'q', 'H', 'L', 'Q', 'QN', 'GCLK', 'CON', 'SN'),
+    #                Port.Direction.OUTPUT),
+    # Sky130:
+    **dict.fromkeys(('COUT', 'COUT_N', 'GCLK', 'HI', 'LO', 'Q', 'Q_N', 'SUM',
+                     'X', 'Y', 'Z'), Port.Direction.OUTPUT),
+}
+
+
 class ExternalModule:
   
   def __init__(self):
@@ -467,6 +561,9 @@ class ExternalModule:
     if name in self.signals:
       return self.signals[name]
     # print(f'module {self.name} creating signal named "{name}"') ## Shut up already WE KNOW!
+    # Names are repeated across signals, ports, port orders and connections;
+    # interning keeps one copy of each and makes comparing them cheap.
+    name = sys.intern(name)
     signal = Signal(name, width=width)
     self.signals[name] = signal
     return signal
@@ -475,6 +572,7 @@ class ExternalModule:
     if name in self.ports:
       return self.ports[name]
     print(f'module {self.name} creating port named "{name}" width={width} direction={direction}')
+    name = sys.intern(name)
     port = Port()
     port.name = name
     port.direction = direction
@@ -556,24 +654,15 @@ class ExternalModule:
     # raise RuntimeError('Check this function and make sure it correctly guesses '
     #                    'port directions for your PDK.')
 
-    if port_name in ('d', 'g', 's', 'b'):
-      return Port.Direction.NONE
-      
-    if port_name in ('VDD', 'VSS', 'VPWR', 'VGND'):
-      return Port.Direction.INOUT
-    #elif port_name in ('Y', 'q', 'H', 'L', 'Q', 'QN', 'GCLK', 'CON', 'SN'):
-    #  # ASAP7
-    #  return Port.Direction.OUTPUT
-    elif port_name in ('COUT', 'COUT_N', 'GCLK', 'HI', 'LO', 'Q', 'Q_N', 'SUM',
-                       'X', 'Y', 'Z'):
-      # Sky130
-      return Port.Direction.OUTPUT
-    else:
-      return Port.Direction.INPUT
+    return GUESSED_PORT_DIRECTIONS.get(port_name, Port.Direction.INPUT)
 
 
 class Module(ExternalModule):
 
+  # Tags for the kinds of entity a pickled signal connects to.
+  PICKLED_PORT = 0
+  PICKLED_CONNECTION = 1
+
   def __init__(self):
     ExternalModule.__init__(self)
 
@@ -597,12 +686,190 @@ class Module(ExternalModule):
     
     this = cls()
     ModuleReader.LoadAST(this, ast_node)
-    return this 
+    return this
+
+  @classmethod
+  def FromYosysJSON(cls, name: str, json_module: dict) -> "Module":
+    """ Create a `Module` from a module in Yosys' JSON netlist output. """
+    from verilog import YosysModuleReader
+
+    this = cls()
+    YosysModuleReader.LoadJSON(this, name, json_module)
+    return this
 
   def __repr__(self):
     desc = f'[module {self.name}]'
     return desc
 
+  def __getstate__(self):
+    """Flatten the netlist so that pickling doesn't recurse through it.
+
+    Signals, Connections and Instances all refer to each other, so the default
+    pickler recurses once per hop across the netlist and runs out of stack on
+    any sizeable design. Instead, store them as tables that refer to each other
+    by name and rebuild the links in __setstate__. """
+    state = self.__dict__.copy()
+    signal_names = {id(signal): name for name, signal in self.signals.items()}
+    port_names = {id(port): name for name, port in self.ports.items()}
+
+    def ConnectedRef(connection):
+      if connection.concat is not None:
+        raise NotImplementedError(
+            f'cannot pickle connection to concat: {connection}')
+      if connection.signal is not None:
+        return (signal_names[id(connection.signal)], None, None)
+      if connection.slice is not None:
+        return (signal_names[id(connection.slice.signal)],
+                connection.slice.top, connection.slice.bottom)
+      return None
+
+    def OrderedRef(target):
+      if target is None:
+        return None
+      if isinstance(target, Slice):
+        return (signal_names[id(target.signal)], target.top, target.bottom)
+      return (signal_names[id(target)], None, None)
+
+    instances = []
+    for name, instance in self.instances.items():
+      # The outgoing_connections cache is left to be rebuilt.
+      instance_state = {
+          attr: getattr(instance, attr) for attr in Instance.__slots__
+          if attr != 'outgoing_connections'}
+      instance_state['connections'] = [
+          (port_name, ConnectedRef(connection))
+          for port_name, connection in instance.connections.items()]
+      # These are Signals, Slices or None.
+      instance_state['connections_by_order'] = [
+          OrderedRef(target) for target in instance.connections_by_order]
+      # Primitives are shared module-level singletons; refer to them by name.
+      is_primitive = (
+          instance.module is not None and
+          instance.module is PRIMITIVE_MODULES.get(instance.module_name))
+      if is_primitive:
+        instance_state['module'] = None
+      instances.append((name, type(instance), instance_state, is_primitive))
+    state['instances'] = instances
+
+    state['ports'] = [
+        (name, port.name, signal_names.get(id(port.signal)), port.direction,
+         port.capacitance)
+        for name, port in self.ports.items()]
+
+    signals = []
+    instance_names = {
+        id(instance): name for name, instance in self.instances.items()}
+    for name, signal in self.signals.items():
+      connects = []
+      for index, entities in signal.connects.items():
+        for entity in entities:
+          # Anything that isn't one of this module's ports or live instance
+          # connections is a stale reference and is dropped.
+          if isinstance(entity, Port):
+            if id(entity) in port_names:
+              connects.append(
+                  (index, Module.PICKLED_PORT, port_names[id(entity)], None))
+            continue
+          instance_name = instance_names.get(id(entity.instance))
+          if instance_name is None or (
+              entity.instance.connections.get(entity.port_name) is not entity):
+            continue
+          # Positional connections have no port name, so the kind of entity
+          # is recorded explicitly rather than implied by port_name.
+          connects.append((index, Module.PICKLED_CONNECTION, instance_name,
+                           entity.port_name))
+      signals.append((
+          name, signal.name, signal.width, signal.parent_name,
+          [port_names[id(port)] for port in signal.ports],
+          connects))
+    state['signals'] = signals
+    return state
+
+  def __setstate__(self, state):
+    signals = state.pop('signals')
+    ports = state.pop('ports')
+    instances = state.pop('instances')
+    self.__dict__.update(state)
+
+    # Unpickled strings are new copies, so intern names again to share them
+    # with the rest of the design, as GetOrCreateSignal and friends do.
+    intern = sys.intern
+
+    self.signals = {}
+    for name, signal_name, width, parent_name, _, _ in signals:
+      signal = Signal(intern(signal_name), width=width)
+      signal.parent_name = parent_name
+      self.signals[intern(name)] = signal
+
+    self.ports = {}
+    for name, port_name, signal_name, direction, capacitance in ports:
+      port = Port()
+      port.name = intern(port_name) if port_name is not None else None
+      port.signal = (self.signals[signal_name]
+                     if signal_name is not None else None)
+      port.direction = direction
+      port.capacitance = capacitance
+      self.ports[intern(name)] = port
+
+    self.instances = {}
+    for name, instance_type, instance_state, is_primitive in instances:
+      instance = instance_type.__new__(instance_type)
+      instance.outgoing_connections = None
+      connections = instance_state.pop('connections')
+      connections_by_order = instance_state.pop('connections_by_order')
+      for attr, value in instance_state.items():
+        setattr(instance, attr, value)
+      if instance.name is not None:
+        instance.name = intern(instance.name)
+      if instance.module_name is not None:
+        instance.module_name = intern(instance.module_name)
+      if is_primitive:
+        instance.module = PRIMITIVE_MODULES[instance.module_name]
+      instance.connections = {}
+      for port_name, ref in connections:
+        if port_name is not None:
+          port_name = intern(port_name)
+        connection = Connection(port_name)
+        connection.instance = instance
+        if ref is not None:
+          signal_name, top, bottom = ref
+          if top is None:
+            connection.signal = self.signals[signal_name]
+          else:
+            connection.slice = Slice()
+            connection.slice.signal = self.signals[signal_name]
+            connection.slice.top = top
+            connection.slice.bottom = bottom
+        instance.connections[port_name] = connection
+      if isinstance(instance, TwoEndedElement):
+        instance.connections_by_order = ()
+      else:
+        instance.connections_by_order = [
+            self._FromOrderedRef(ref) for ref in connections_by_order]
+      self.instances[intern(name)] = instance
+
+    for name, _, _, _, signal_ports, connects in signals:
+      signal = self.signals[name]
+      signal.ports.update(self.ports[port_name] for port_name in signal_ports)
+      for index, kind, key, port_name in connects:
+        if kind == Module.PICKLED_PORT:
+          signal.Connect(self.ports[key], index=index)
+        else:
+          signal.Connect(
+              self.instances[key].connections[port_name], index=index)
+
+  def _FromOrderedRef(self, ref):
+    if ref is None:
+      return None
+    signal_name, top, bottom = ref
+    if top is None:
+      return self.signals[signal_name]
+    target = Slice()
+    target.signal = self.signals[signal_name]
+    target.top = top
+    target.bottom = bottom
+    return target
+
   def Show(self):
     print(f'module: {self.name}')
     print(f'\t{len(self.ports)} ports:')
@@ -664,18 +931,19 @@ class Module(ExternalModule):
 
       # Seen should contain... ports and connections.
       # If it contained instances you wouldn't be able to weave in and out of
-      # the same instance.
-      seen = set([starting_path.start, starting_path.steps[-1]])
+      # the same instance. The first step is added when it is visited.
+      seen = set([starting_path.start])
 
-      print('new path')
+      log.debug('new path')
       while to_visit:
         current = to_visit.popleft()
         if not isinstance(current, Connection):
           raise ValueError(f'not sure what to do about a {current}')
-        print(f'current: {current}')
+        log.debug('current: %s', current)
         if current in seen:
-          print(f'seen: {current}')
+          log.debug('seen: %s', current)
           continue
+        seen.add(current)
 
         # We have arrived at the instance of some module on one of its ports.
         # We follow all INOUT and OUTPUT ports from this module. The instance
@@ -684,38 +952,34 @@ class Module(ExternalModule):
         instance = current.instance
 
         if instance.module.is_sequential:
-          print('TODO(growly): Stop here')
+          log.debug('TODO(growly): Stop here')
 
         module = instance.module
-        for port_name, connection in instance.connections.items():
-          if port_name == inbound_port_name:
-            continue
-          if connection.DirectionOfInstancePort() not in (
-              Port.Direction.OUTPUT, Port.Direction.INOUT):
+        for connection in instance.OutgoingConnections():
+          if connection.port_name == inbound_port_name:
             continue
           # At this point we know the exit port from the instance (it's given
           # in 'connection').
           slice_or_signal = connection.GetConnected()
           if isinstance(slice_or_signal, Slice):
             index = slice_or_signal.bottom
-            sinks = set(slice_or_signal.signal.connects[index])
+            sinks = set(slice_or_signal.signal.Connects(index))
             assert connection in sinks, (
                 'connection should be in the list of connected objects which it '
                 'purportedly connects')
             sinks.remove(connection)
-            for sink in sinks:
-              to_visit.append(sink)
+            to_visit.extend(sink for sink in sinks if sink not in seen)
 
           # 'connection' is the outgoing port/signal pair.
           #to_visit.append(connection)
-      print('done')
+      log.debug('done')
 
   # TODO(growly): Stop search at GND and VSS!
 
   @staticmethod
   def FindConnectedRegionBetweenPorts(
       source_port, sink_port, source_range=None, sink_range=None,
-      ignore_signals=set()):
+      ignore_signals=frozenset()):
     # We traverse a graph of:
     #             +--------+                +----------+                +--------+
     #             | Signal |                | Instance |                | Signal |
@@ -737,11 +1001,12 @@ class Module(ExternalModule):
     sink_high = sink_range[1] if sink_range is not None else sink.signal.width - 1
 
     seen = set([source_port])
-    to_visit = collections.deque()
+    frontier = []
+    inout_wires = set()
 
     for i in range(source_high - source_low + 1):
       k = i + source_low
-      to_visit.extend([x for x in source_port.signal.connects[k] if x != source_port])
+      frontier.extend([x for x in source_port.signal.Connects(k) if x != source_port])
 
     some_sink_found = False
 
@@ -751,51 +1016,57 @@ class Module(ExternalModule):
     sink_wires = sink_port.EnumerateWires(low=sink_low, high=sink_high+1)
     region.AddWiresForDirection(sink_wires, sink_port.direction)
 
-    while to_visit:
-      current = to_visit.popleft()
-      # print(current)
-      if isinstance(current, Port):
-        if current is sink_port:
-          # We're done.
-          seen.add(current)
-          some_sink_found = True
-      elif isinstance(current, Connection):
-        # 'current' is an incoming connection to an instance, since we
-        # process outgoing connections below.
-        instance = current.instance
-        if instance.module.is_sequential:
-          # This is a timing boundary; do not consider outputs connected.
-          continue
-        region.instances.add(instance)
-        for port_name, outgoing in current.instance.connections.items():
-          #pdb.set_trace()
-          if outgoing is current:
-            # Skip the incoming port.
-            continue
-          if outgoing in seen:
+    # Search level by level, swapping lists, rather than popping a deque one
+    # entry at a time.
+    while frontier:
+      next_frontier = []
+      for current in frontier:
+        # print(current)
+        if isinstance(current, Port):
+          if current is sink_port:
+            # We're done.
+            seen.add(current)
+            some_sink_found = True
+        elif isinstance(current, Connection):
+          # 'current' is an incoming connection to an instance, since we
+          # process outgoing connections below.
+          instance = current.instance
+          if instance.module.is_sequential:
+            # This is a timing boundary; do not consider outputs connected.
             continue
+          if instance not in region.instances:
+            region.instances.add(instance)
+            # All of the instance's pins are pins of the region.
+            for connection in instance.connections.values():
+              inout_wires.update(connection.EnumerateWires())
           # Only follow outputs.
-          if outgoing.DirectionOfInstancePort() not in (
-              Port.Direction.OUTPUT, Port.Direction.INOUT):
-            continue
-          if outgoing.GetConnectedSignal().name in ignore_signals:
-            continue
-          #print(f'finding signals connected to {outgoing.GetConnectedSignal().name}')
-          seen.add(outgoing)
-          slice_or_signal = outgoing.GetConnected()
-          for next_port_or_connection in slice_or_signal.Connects():
-            if next_port_or_connection in seen:
+          for outgoing in instance.OutgoingConnections():
+            if outgoing is current:
+              # Skip the incoming port.
               continue
-            seen.add(next_port_or_connection)
-            to_visit.append(next_port_or_connection)
-      else:
-        raise NotImplementedError()
+            if outgoing in seen:
+              continue
+            signal = outgoing.GetConnectedSignal()
+            if signal.name in ignore_signals:
+              continue
+            #print(f'finding signals connected to {signal.name}')
+            seen.add(outgoing)
+            # Walk the per-index sets directly rather than building their union
+            # on every hop.
+            high, low = outgoing.IndexOnSignal()
+            for index in range(low, high + 1):
+              for next_port_or_connection in signal.Connects(index):
+                if next_port_or_connection in seen:
+                  continue
+                seen.add(next_port_or_connection)
+                next_frontier.append(next_port_or_connection)
+        else:
+          raise NotImplementedError()
+      frontier = next_frontier
 
-    inout_wires = set()
-    for instance in region.instances:
-      for connection in instance.connections.values():
-        inout_wires.update(connection.EnumerateWires())
-    region.AddWiresForDirection(sorted(inout_wires), Port.Direction.INOUT)
+    # The region keeps wires in sets; OrderedWires sorts them when they are
+    # written out.
+    region.AddWiresForDirection(inout_wires, Port.Direction.INOUT)
 
 
     if some_sink_found:
@@ -810,6 +1081,54 @@ class Module(ExternalModule):
       return region
     return None
 
+  @staticmethod
+  def _FindConnectionsTo(current):
+    connections = None
+    signal = None
+    indices = None
+    if isinstance(current, Wire):
+      signal = current.signal
+      connections = current.Connects()
+      indices = (current.index, current.index)
+    elif isinstance(current, Connection):
+      # This is GetConnectedSignal, IndexOnSignal and GetConnected in one go.
+      if current.signal is not None:
+        signal = current.signal
+        assert signal.width == 1
+        indices = (0, 0)
+        connections = signal.Connects(0)
+      elif current.slice is not None:
+        signal = current.slice.signal
+        assert current.slice.top == current.slice.bottom
+        indices = (current.slice.top, current.slice.bottom)
+        connections = signal.Connects(current.slice.bottom)
+      else:
+        # Concatenations are not supported.
+        raise NotImplementedError()
+    else:
+      raise NotImplementedError()
+    return connections, signal, indices
+
+  # This says nothing of the direction of the connection, only that it is an edge
+  # connected to the node (instance) and it is not the one we came in on
+  # (incoming connection).
+  @staticmethod
+  def _FindOutgoingConnectionsFrom(
+      instance, incoming_connection, ignore_signals):
+    viable = []
+    for _, outgoing in instance.connections.items():
+      if outgoing is incoming_connection:
+        continue
+      if outgoing.GetConnectedSignal().name in ignore_signals:
+        continue
+      # Do not continue through this instance through ports which are
+      # strictly INPUTs.
+      #if outgoing.DirectionOfInstancePort() not in (
+      #    Port.Direction.OUTPUT, Port.Direction.INOUT):
+      #  continue
+      viable.append(outgoing)
+    return viable
+
   # TODO(growly): Ok big problem is that we're assuming that the netlist is
   # flattened into single-width wires everywhere, but this is only because the
   # SPEF extraction gives us this view. The Wire class helps with this but it
@@ -817,149 +1136,112 @@ class Module(ExternalModule):
 
   @staticmethod
   def FindConnectedSubgraphFrom(start, ignore_signals):
+    # Returns the region, the Ports and Connections seen while finding it,
+    # and the Connections from which to look for neighbouring regions.
     next_starting_points = collections.deque()
-    to_visit = collections.deque([start])
+    frontier = [start]
     seen = set()
 
     # A region is made up of Instances in the interior and Wires at the edges.
     # The Wires refer to existing signals.
     region = DesignRegion()
 
-    # Coupling capacitances below this value are considered boundaries for the
-    # subgraph.
-    COUPLING_CAP_LIMIT = NumericalValue(100, SIUnitPrefix.ATTO)
-
-    def FindConnectionsTo(current):
-      connections = None
-      signal = None
-      indices = None
-      if isinstance(current, Wire):
-        signal = current.signal
-        connections = current.Connects()
-        indices = (current.index, current.index)
-      elif isinstance(current, Connection):
-        signal = current.GetConnectedSignal()
-        indices = current.IndexOnSignal()
-        slice_or_signal = current.GetConnected()
-        if isinstance(slice_or_signal, Slice):
-          assert slice_or_signal.top == slice_or_signal.bottom
-          connections = slice_or_signal.signal.Connects(slice_or_signal.bottom)
-        if isinstance(slice_or_signal, Signal):
-          assert slice_or_signal.width == 1
-          connections = slice_or_signal.Connects()
-      else:
-        raise NotImplementedError()
-      return connections, signal, indices
-
-    # This says nothing of the direction of the connection, only that it is an edge
-    # connected to the node (instance) and it is not the one we came in on
-    # (incoming connection).
-    def FindOutgoingConnectionsFrom(instance, incoming_connection):
-      viable = []
-      for _, outgoing in instance.connections.items():
-        if outgoing is incoming_connection:
-          continue
-        if outgoing.GetConnectedSignal().name in ignore_signals:
-          continue
-        # Do not continue through this instance through ports which are
-        # strictly INPUTs.
-        #if outgoing.DirectionOfInstancePort() not in (
-        #    Port.Direction.OUTPUT, Port.Direction.INOUT):
-        #  continue
-        viable.append(outgoing)
-      return viable
-
     # This search works by hopping from net to net; at each net, we find all
     # the connected instances (cells) and inspect their type. Depending on the
     # type, we continue the search through them, or we do not.
-    while to_visit:
-      current = to_visit.popleft()
-      if current in seen:
-        continue
-
-      # Find candidate connections to this wire/signal.
-      connections, signal, indices = FindConnectionsTo(current)
-      if signal.name in ignore_signals:
-        continue
-
-      # to_visit contains egress connections attached to some instance.
-      # We have to search for the ingress connections connected to the
-      # egress signal, then find the egress connections from those instances
-      # to add back to the to_visit queue.
-      for connection in connections:
-        if connection in seen:
-          continue
-        seen.add(connection)
-
-        # From our seed connection ('current'), we are connected through a
-        # Signal to either Ports or Connections. Ports are boundaries.
-        # Connections represent instances, which are either interior to the
-        # subgraph of interest or boundaries. Ports do not present additional
-        # avenues to continue the search. Interior instances do. Boundary
-        # instances otherwise provide new starting points for the search.
-
-        if isinstance(connection, Port):
-          # Ports are boundaries, so we need to add this to the covered
-          # subgraph but not pursue it.
-          port = connection
-          wires = [Wire(port.signal, k + indices[0]) for k in range(indices[1] - indices[0] + 1)]
-          region.AddWiresForDirection(wires, port.direction)
-          region.AttachPorts(wires)
-          if port.direction in (Port.Direction.INPUT,):
-            region.AttachSimulatedDrivers(wires)
-          elif port.direction in (Port.Direction.OUTPUT,):
-            region.AttachVoltageProbes(wires)
+    # The search proceeds level by level, as in FindConnectedRegionBetweenPorts.
+    # Anything already seen is also filtered out as it is queued, below; the
+    # check on 'current' catches the seed and connections seen after being
+    # queued.
+    while frontier:
+      next_frontier = []
+      for current in frontier:
+        if current in seen:
           continue
 
-        assert(isinstance(connection, Connection))
-
-        instance = connection.instance
-        #if instance in seen:
-        #  continue
-        outgoing = FindOutgoingConnectionsFrom(instance, connection)
-        if instance.module == RESISTOR:
-          region.instances.add(instance)
-          to_visit.extend(outgoing)
-        elif instance.module == CAPACITOR:
-          region.instances.add(instance)
-          capacitance = instance.parameters['capacitance']
-          if capacitance >= COUPLING_CAP_LIMIT:
-            to_visit.extend(outgoing)
-          else:
-            # We include the capacitor as a boundary element but do not follow
-            # its connections. The external pin(s) is now a probe point, or
-            # possibly a bias point.
-            for external in outgoing:
-              wires = external.EnumerateWires()
-              region.AddWiresForOppositeDirection(wires, external.DirectionOfInstancePort())
-              region.AttachBias(wires)
-        else:
-          assert(not instance.module.is_passive)
-
-          # In this case, the boundary instance is excluded from the interior
-          # outright. The outgoing connections on the other side of the
-          # instance are used as seeds to search for the next connected
-          # subgraph. The incoming connection is used for probes, and to define
-          # boundary pins.
-          wires = connection.EnumerateWires()
-          region.AddWiresForOppositeDirection(wires, connection.DirectionOfInstancePort())
-          region.AttachPorts(wires)
-
-          if connection.DirectionOfInstancePort() in (
-              Port.Direction.INPUT, Port.Direction.INOUT):
-            region.AttachVoltageProbes(wires)
-          elif connection.DirectionOfInstancePort() == Port.Direction.OUTPUT:
-            region.AttachSimulatedDrivers(wires)
-
-          # If we have data on the load capacitance at this boundary (i.e. the
-          # input capacitance to a module), we include it as a simulated load.
-          if type(instance.module) is ExternalModule and (
-              connection.DirectionOfInstancePort() == Port.Direction.INPUT):
-            region.AttachCapacitiveLoads(instance, connection, update_ports=True)
+        # Find candidate connections to this wire/signal.
+        connections, signal, indices = Module._FindConnectionsTo(current)
+        if signal.name in ignore_signals:
+          continue
 
-          next_starting_points.extend(outgoing)
+        # The frontier contains egress connections attached to some instance.
+        # We have to search for the ingress connections connected to the
+        # egress signal, then find the egress connections from those instances
+        # to add back to the search frontier.
+        for connection in connections:
+          if connection in seen:
+            continue
+          seen.add(connection)
+
+          # From our seed connection ('current'), we are connected through a
+          # Signal to either Ports or Connections. Ports are boundaries.
+          # Connections represent instances, which are either interior to the
+          # subgraph of interest or boundaries. Ports do not present additional
+          # avenues to continue the search. Interior instances do. Boundary
+          # instances otherwise provide new starting points for the search.
+
+          if isinstance(connection, Port):
+            # Ports are boundaries, so we need to add this to the covered
+            # subgraph but not pursue it.
+            port = connection
+            wires = [Wire(port.signal, k + indices[0]) for k in range(indices[1] - indices[0] + 1)]
+            region.AddWiresForDirection(wires, port.direction)
+            region.AttachAll(
+                wires,
+                drivers=port.direction == Port.Direction.INPUT,
+                probes=port.direction == Port.Direction.OUTPUT)
+            continue
 
-        seen.add(instance)
+          assert(isinstance(connection, Connection))
+
+          instance = connection.instance
+          #if instance in seen:
+          #  continue
+          outgoing = Module._FindOutgoingConnectionsFrom(
+              instance, connection, ignore_signals)
+          module = instance.module
+          if module is RESISTOR:
+            region.instances.add(instance)
+            next_frontier.extend(c for c in outgoing if c not in seen)
+          elif module is CAPACITOR:
+            region.instances.add(instance)
+            capacitance = instance.parameters['capacitance']
+            # Same test as capacitance >= COUPLING_CAP_LIMIT, which
+            # NumericalValue implements as COUPLING_CAP_LIMIT < capacitance.
+            if COUPLING_CAP_LIMIT_BY_UNIT[capacitance.unit] < capacitance.value:
+              next_frontier.extend(c for c in outgoing if c not in seen)
+            else:
+              # We include the capacitor as a boundary element but do not follow
+              # its connections. The external pin(s) is now a probe point, or
+              # possibly a bias point.
+              for external in outgoing:
+                wires = external.EnumerateWires()
+                region.AddWiresForOppositeDirection(wires, external.DirectionOfInstancePort())
+                region.AttachBias(wires)
+          else:
+            assert(not module.is_passive)
+
+            # In this case, the boundary instance is excluded from the interior
+            # outright. The outgoing connections on the other side of the
+            # instance are used as seeds to search for the next connected
+            # subgraph. The incoming connection is used for probes, and to define
+            # boundary pins.
+            wires = connection.EnumerateWires()
+            direction = connection.DirectionOfInstancePort()
+            region.AddWiresForOppositeDirection(wires, direction)
+            region.AttachAll(
+                wires,
+                probes=direction in (Port.Direction.INPUT, Port.Direction.INOUT),
+                drivers=direction == Port.Direction.OUTPUT)
+
+            # If we have data on the load capacitance at this boundary (i.e. the
+            # input capacitance to a module), we include it as a simulated load.
+            if type(module) is ExternalModule and (
+                direction == Port.Direction.INPUT):
+              region.AttachCapacitiveLoads(instance, connection, update_ports=True)
+
+            next_starting_points.extend(outgoing)
+      frontier = next_frontier
 
     return region, seen, next_starting_points
 
@@ -974,38 +1256,43 @@ class Module(ExternalModule):
     # FIXME(growly): '.NODESET' seems to do what we use 'DC source' for;
     # meaning it sets the initial conditions of a net where we introduce a DC
     # bias.
-    ignore_signals = ignore_signals or set(['GND', 'VSS', 'VDD'])
+    ignore_signals = ignore_signals or frozenset(('GND', 'VSS', 'VDD'))
 
-    print(f'seed: {seed}')
+    log.debug('seed: %s', seed)
 
+    # NOTE(growly): This is inherently sequential. Whether a starting point
+    # yields a new region depends on what the regions before it covered, and
+    # the search works on the live netlist objects, so worker processes would
+    # each need a copy of the whole module and would find overlapping regions.
+    #
     # These are Ports or Connections, which refer to Ports of Instances.
     starting_points = collections.deque([seed])
 
-    # This is going to get huge.
+    # This is going to get huge. Starting points are only ever Connections (or
+    # the seed), so that is all it needs to hold; the instances and ports in
+    # each region's 'seen' are left out.
     globally_seen = set()
 
     num_subgraphs = 0
     while starting_points:
       start = starting_points.popleft()
       if start in globally_seen:
-        #print(f'start {start} in globally seen; skipping')
         continue
-      else:
-        #print(f'start is: {start}')
-        pass
 
       subgraph, seen, next_starting_points = Module.FindConnectedSubgraphFrom(start, ignore_signals)
       num_subgraphs += 1
       subgraph.name = f'region.{num_subgraphs}'
 
-      globally_seen.update(seen)
-      starting_points.extend(next_starting_points)
+      globally_seen.update(
+          entity for entity in seen if type(entity) is Connection)
+      # Boundaries shared by neighbouring regions would otherwise pile up in
+      # the queue, only to be skipped when popped.
+      starting_points.extend(
+          point for point in next_starting_points
+          if point not in globally_seen)
 
       yield subgraph
 
-      #if num_subgraphs == 1:
-      #  break
-
 
 class VerilogIdentifier:
 
@@ -1016,26 +1303,31 @@ class VerilogIdentifier:
     self._Parse()
 
   def _Parse(self):
+    self.raw = VerilogIdentifier._ParseRaw(self.source_text)
+
+  # The same identifiers (cell pin names, power nets) recur throughout a
+  # netlist, so parse results are cached.
+  @staticmethod
+  @functools.lru_cache(maxsize=1 << 16)
+  def _ParseRaw(source_text):
     # Try to reduce the identifier to the sequence of ASCII characters
     # it represents, after digesting the escaping permitted in the Verilog
     # file.
     #
     # See section 5.6 in the IEEE Verilog spec.
-    if self.source_text.startswith('\\'):
+    if source_text.startswith('\\'):
       # The identifier should end with a space, per section 5.6.1.
-      if self.source_text.endswith(' '):
-        self.raw = self.source_text[1:-1]
-      else:
-        # This isn't technically legal but it looks like pyverilog drops the
-        # trailing space.
-        self.raw = self.source_text[1:]
+      if source_text.endswith(' '):
+        return source_text[1:-1]
+      # This isn't technically legal but it looks like pyverilog drops the
+      # trailing space.
+      return source_text[1:]
 
-    else:
-      # It's not clear to me if by this point the identifier is just a string
-      # with pesky escape characters (backslashes), or if we have to understand
-      # hierarchical naming (dot-delimited), or if we have to understand and
-      # extract bus indices, etc. I'll assume the former.
-      self.raw = self.source_text.replace('\\', '')
+    # It's not clear to me if by this point the identifier is just a string
+    # with pesky escape characters (backslashes), or if we have to understand
+    # hierarchical naming (dot-delimited), or if we have to understand and
+    # extract bus indices, etc. I'll assume the former.
+    return source_text.replace('\\', '')
 
 
 class DesignRegion:
@@ -1049,12 +1341,27 @@ class DesignRegion:
     MODULE = 2
     EXTERNAL_MODULE = 3
 
-  def __init__(self, instances=set()):
-    #self.design = design
+  __slots__ = ('name', 'dut_type', 'instances', 'module', 'dc_biases',
+               'dc_sources', 'loads', 'simulated_drivers', 'voltage_probes',
+               'subcircuit_delay_measurements', 'subcircuit_voltage_probes',
+               'port_network_ports', 'input_wires', 'inout_wires',
+               'output_wires', 'in_wires', 'out_wires', 'transient_pbs',
+               'linear_pbs', 'other_delays', 'linear_analyses', 'fft_results',
+               'other_measurements', 'probe_results')
+
+  WIRES_ATTRIBUTE_BY_DIRECTION = {
+      Port.Direction.INPUT: 'input_wires',
+      Port.Direction.OUTPUT: 'output_wires',
+      Port.Direction.INOUT: 'inout_wires'
+  }
+
+  def __init__(self, instances=None):
     self.name = 'unnamed'
     self.dut_type = DesignRegion.DUTType.SUB_REGION
 
-    self.instances = instances
+    # Each region needs its own set; a shared default would collect every
+    # region's instances.
+    self.instances = instances if instances is not None else set()
     self.module = None
 
     # Simulation set up and probes.
@@ -1092,14 +1399,10 @@ class DesignRegion:
     self.probe_results = {}
 
   def AddWiresForDirection(self, wires, direction):
-    if direction == Port.Direction.INPUT:
-      self.input_wires.update(wires)
-    elif direction == Port.Direction.OUTPUT:
-      self.output_wires.update(wires)
-    elif direction == Port.Direction.INOUT:
-      self.inout_wires.update(wires)
-    else:
+    attribute = DesignRegion.WIRES_ATTRIBUTE_BY_DIRECTION.get(direction)
+    if attribute is None:
       raise NotImplementedError(f'cannot add wires; unknown direction: {direction}')
+    getattr(self, attribute).update(wires)
 
   def AddWiresForOppositeDirection(self, wires, direction):
     if direction == Port.Direction.INPUT:
@@ -1126,9 +1429,27 @@ class DesignRegion:
     self.voltage_probes.update(
         {wire.SpiceName(): spice.VoltageProbe(wire) for wire in wires})
 
+  def AttachAll(self, wires, ports=True, probes=False, drivers=False,
+                bias=False):
+    """Does the work of AttachPorts, AttachVoltageProbes,
+    AttachSimulatedDrivers and AttachBias in one pass over wires.
+
+    As in AttachPorts, a wire that already has a port keeps it (along with any
+    load capacitance set on it); probes, drivers and biases are replaced."""
+    for wire in wires:
+      name = wire.SpiceName()
+      if ports and name not in self.port_network_ports:
+        self.port_network_ports[name] = spice.Port(wire)
+      if probes:
+        self.voltage_probes[name] = spice.VoltageProbe(wire)
+      if drivers:
+        self.simulated_drivers[name] = spice.SimulatedDriver(wire)
+      if bias:
+        self.dc_biases[name] = spice.DCVoltageSource(wire)
+
   def AttachCapacitiveLoads(self, instance, connection, update_ports=True):
     port_name = connection.port_name
-    wires = EnumerateWiresInConnection(connection)
+    wires = connection.EnumerateWires()
     module = instance.module
     assert(type(module) is ExternalModule)
     for i, wire in enumerate(wires):
@@ -1136,13 +1457,12 @@ class DesignRegion:
           port_name, i)
       if not input_capacitance:
         continue
+      spice_name = wire.SpiceName()
       if update_ports:
-        try:
-          port = port_network_ports[wire.SpiceName()]
+        port = self.port_network_ports.get(spice_name)
+        if port is not None:
           port.load_capacitance = NumericalValue(input_capacitance, None)
-        except KeyError:
-          pass
-      loads[wire.SpiceName()] = spice.CapacitiveLoad(
+      self.loads[spice_name] = spice.CapacitiveLoad(
           wire, NumericalValue(input_capacitance, None))
 
   def HasResultsForTag(self, tag):
@@ -1155,20 +1475,19 @@ class DesignRegion:
     return False
 
   def OrderedWires(self):
-    all_wires = []
     if self.dut_type in (
         DesignRegion.DUTType.MODULE, DesignRegion.DUTType.EXTERNAL_MODULE) and (
             self.module is not None):
-      for port_name in self.module.port_order:
-        port = self.module.ports[port_name]
-        all_wires.extend(Wire(port.signal, i) for i in range(port.signal.width))
-    else:
-      all_wires = list(self.input_wires | self.inout_wires | self.output_wires)
-      all_wires.sort(key=lambda x: (x.signal.name, x.index))
-    return all_wires
+      ports = self.module.ports
+      signals = [ports[port_name].signal for port_name in self.module.port_order]
+      return [Wire(signal, i) for signal in signals for i in range(signal.width)]
+    return sorted(self.input_wires | self.inout_wires | self.output_wires,
+                  key=lambda x: (x.signal.name, x.index))
 
 
 class TimingPath:
+  __slots__ = ('start', 'steps')
+
   def __init__(self, start):
     self.start = start
     self.steps = []
@@ -14,16 +14,32 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import tempfile
+
 from google.protobuf import text_format
+from google.protobuf.internal import api_implementation
 
-import pdb
 import circuit
 import circuit_pb2 as circuit_pb
 import utils_pb2 as utils_pb
 from spice_util import SIUnitPrefix
 
+log = logging.getLogger(__name__)
+
+# Bump this when the pickled form of Modules changes, so that
+# ReadProtoToDesign stops loading stale cache entries.
+DESIGN_CACHE_VERSION = 2
+
 class CircuitWriter():
 
+  # Whether the slow protobuf runtime has been warned about yet.
+  warned_slow_protobuf = False
+
   CIRCUIT_TO_PB_PORT_DIRECTION_MAP = {
       circuit.Port.Direction.INPUT: circuit_pb.Port.Direction.INPUT,
       circuit.Port.Direction.OUTPUT: circuit_pb.Port.Direction.OUTPUT,
@@ -63,34 +79,54 @@ class CircuitWriter():
     v: k for k, v in CIRCUIT_TO_PB_SI_PREFIX_MAP.items()
   }
 
+  # CIRCUIT_TO_PB_SI_PREFIX_MAP keyed by each SIUnitPrefix's exponent, which
+  # avoids hashing an Enum for every parameter written. None (no prefix) keeps
+  # its entry.
+  PB_SI_PREFIX_BY_VALUE = {
+      None if prefix is None else prefix.value: prefix_pb
+      for prefix, prefix_pb in CIRCUIT_TO_PB_SI_PREFIX_MAP.items()
+  }
+
+  # Which field of a (prefixed) value proto holds each type of number.
+  NUMBER_FIELD_BY_TYPE = {
+      float: 'double',
+      int: 'integer',
+  }
+
   def __init__(self, design):
     self.design = design
+    CircuitWriter.WarnIfSlowProtobuf()
+
+  @staticmethod
+  def WarnIfSlowProtobuf():
+    # Loading and saving large designs is dominated by protobuf
+    # (de)serialisation, which is many times slower in the pure-Python runtime
+    # than in the native (upb or cpp) ones that the protobuf wheels ship.
+    if CircuitWriter.warned_slow_protobuf:
+      return
+    CircuitWriter.warned_slow_protobuf = True
+    if api_implementation.Type() == 'python':
+      log.warning(
+          'protobuf is using its pure-Python implementation; loading and '
+          'saving circuit protos will be slow. Unset '
+          'PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION or install a protobuf wheel '
+          'with native support')
 
   @staticmethod 
   def ToPortDirection(direction):
-    try:
-      return CircuitWriter.CIRCUIT_TO_PB_PORT_DIRECTION_MAP[direction]
-    except KeyError:
+    direction_pb = CircuitWriter.CIRCUIT_TO_PB_PORT_DIRECTION_MAP.get(direction)
+    if direction_pb is None:
       raise Exception(f'Unknown port direction: {direction}')
+    return direction_pb
 
   @staticmethod
   def ToSIPrefix(prefix):
     try:
-      return CircuitWriter.CIRCUIT_TO_PB_SI_PREFIX_MAP[prefix]
-    except KeyError:
+      return CircuitWriter.PB_SI_PREFIX_BY_VALUE[
+          None if prefix is None else prefix.value]
+    except (AttributeError, KeyError):
       raise Exception(f'Unknown SI prefix: {prefix}')
 
-  @staticmethod
-  def ToSignal(signal, signal_pb):
-    signal_pb.name = signal.name
-    signal_pb.width = signal.width
-
-  @staticmethod
-  def ToSlice(internal_slice, slice_pb):
-    slice_pb.signal = internal_slice.signal.name
-    slice_pb.top = internal_slice.top
-    slice_pb.bot = internal_slice.bottom
-
   @staticmethod
   def ToPort(port, port_pb):
     port_pb.signal = port.signal.name
@@ -99,15 +135,20 @@ class CircuitWriter():
   @staticmethod
   def ToExternalModule(module, module_pb):
     module_pb.name.name = module.name
+    add_port = module_pb.ports.add
+    to_port = CircuitWriter.ToPort
+    ports = module.ports
     for port_name in module.port_order:
-      if port_name not in module.ports:
+      port = ports.get(port_name)
+      if port is None:
         raise RuntimeError(
             f'port named in port order without associated Port object: {port_name}')
-      port_pb = module_pb.ports.add()
-      port = module.ports[port_name]
-      CircuitWriter.ToPort(port, port_pb)
-    for _, signal in module.signals.items():
-      CircuitWriter.ToSignal(signal, module_pb.signals.add())
+      to_port(port, add_port())
+    add_signal = module_pb.signals.add
+    for signal in module.signals.values():
+      signal_pb = add_signal()
+      signal_pb.name = signal.name
+      signal_pb.width = signal.width
 
   @staticmethod
   def ToParameter(name, value, param_pb):
@@ -119,12 +160,16 @@ class CircuitWriter():
         store_pb = param_pb.value.prefixed
       else:
         store_pb = param_pb.value
-      if isinstance(actual_value, float):
-        store_pb.double = actual_value
-      elif isinstance(actual_value, int) or isinstance(actual_value, long):
-        store_pb.value.prefixed.integer = actual_value
-      else:
-        raise Exception(f'Unknown numerical type: {type(value)} for {value}')
+      field = CircuitWriter.NUMBER_FIELD_BY_TYPE.get(type(actual_value))
+      if field is None:
+        # Subclasses, like numpy's float64, miss the table.
+        if isinstance(actual_value, float):
+          field = 'double'
+        elif isinstance(actual_value, int):
+          field = 'integer'
+        else:
+          raise Exception(f'Unknown numerical type: {type(value)} for {value}')
+      setattr(store_pb, field, actual_value)
     elif isinstance(value, str):
       param_pb.value.string = value
     else:
@@ -137,7 +182,11 @@ class CircuitWriter():
     if connection.signal is not None:
       conn_pb.target.sig = connection.signal.name
     elif connection.slice is not None:
-      CircuitWriter.ToSlice(connection.slice, conn_pb.target.slice)
+      internal_slice = connection.slice
+      slice_pb = conn_pb.target.slice
+      slice_pb.signal = internal_slice.signal.name
+      slice_pb.top = internal_slice.top
+      slice_pb.bot = internal_slice.bottom
     elif connection.concat is not None:
       raise Exception(f'Don\'t know how to map concats in conncections: {connection}')
     else:
@@ -148,69 +197,120 @@ class CircuitWriter():
   def ToInstance(instance, instance_pb):
     instance_pb.name = instance.name
     instance_pb.module.local = instance.module_name
-    for name, value in instance.parameters.items():
-      CircuitWriter.ToParameter(name, value, instance_pb.parameters.add())
+    if instance.parameters:
+      add_parameter = instance_pb.parameters.add
+      to_parameter = CircuitWriter.ToParameter
+      for name, value in instance.parameters.items():
+        to_parameter(name, value, add_parameter())
+    add_connection = instance_pb.connections.add
+    to_connection = CircuitWriter.ToConnection
     for port_name, connection in instance.connections.items():
-      if connection.IsDisconnected():
-        continue
-      CircuitWriter.ToConnection(
-          port_name, connection, instance_pb.connections.add())
+      # Most connections are to whole signals; write those directly.
+      signal = connection.signal
+      if signal is not None:
+        conn_pb = add_connection()
+        conn_pb.portname = port_name
+        conn_pb.target.sig = signal.name
+      elif not connection.IsDisconnected():
+        to_connection(port_name, connection, add_connection())
 
+  @staticmethod
   def ToModule(module, module_pb):
     module_pb.name = module.name
-    for name, value in module.default_parameters.items():
-      CircuitWriter.ToParameter(name, value, module_pb.parameters.add())
+    if module.default_parameters:
+      add_parameter = module_pb.parameters.add
+      for name, value in module.default_parameters.items():
+        CircuitWriter.ToParameter(name, value, add_parameter())
+    add_port = module_pb.ports.add
+    to_port = CircuitWriter.ToPort
+    ports = module.ports
     for port_name in module.port_order:
-      port = module.ports[port_name]
-      CircuitWriter.ToPort(port, module_pb.ports.add())
-    for name, signal in module.signals.items():
-      CircuitWriter.ToSignal(signal, module_pb.signals.add())
-    for name, instance in module.instances.items():
-      CircuitWriter.ToInstance(instance, module_pb.instances.add())
-
-  def ToCircuitProto(self):
+      to_port(ports[port_name], add_port())
+    # These loops run once per signal and instance in the design, so the
+    # repeated-field and method lookups are hoisted out of them.
+    add_signal = module_pb.signals.add
+    for signal in module.signals.values():
+      signal_pb = add_signal()
+      signal_pb.name = signal.name
+      signal_pb.width = signal.width
+    add_instance = module_pb.instances.add
+    to_instance = CircuitWriter.ToInstance
+    for instance in module.instances.values():
+      to_instance(instance, add_instance())
+
+  def PackageChunks(self):
+    """Yields the design's circuit proto as Packages holding one module each.
+
+    Serialised protos concatenate: Packages written back to back, in either
+    the binary or text format, parse as the one Package holding all of their
+    modules. So only one module's proto needs to be in memory at a time."""
     design = self.design
-
-    package_pb = circuit_pb.Package()
-    #package_pb.name = design.top
-    for name, module in design.external_modules.items():
-      CircuitWriter.ToExternalModule(module, package_pb.ext_modules.add())
-    for name, module in design.known_modules.items():
-      CircuitWriter.ToModule(module, package_pb.modules.add())
-
-    return package_pb
-
-  def WriteDesignToTextProto(self, filename):
-    package = self.ToCircuitProto()
-    with open(filename, 'w') as f:
-      f.write(text_format.MessageToString(package))
-
-  def WriteDesignToProto(self, filename):
-    package = self.ToCircuitProto()
-    with open(filename, 'wb') as f:
-      # TODO(growly): bytes-to-string conversion required encoding!
-      f.write(package.SerializeToString())
+    # Messages are filled in place with add(). Building them separately and
+    # extend()ing the repeated field copies each one, which measures over
+    # twice as slow with the upb runtime.
+    for module in design.external_modules.values():
+      chunk_pb = circuit_pb.Package()
+      CircuitWriter.ToExternalModule(module, chunk_pb.ext_modules.add())
+      yield chunk_pb
+    for module in design.known_modules.values():
+      chunk_pb = circuit_pb.Package()
+      CircuitWriter.ToModule(module, chunk_pb.modules.add())
+      yield chunk_pb
+
+  def WriteDesignToTextProto(self, filename, package=None):
+    with open(filename, 'w', buffering=1 << 20) as f:
+      # Print straight into the file instead of into one giant string first.
+      if package is not None:
+        text_format.PrintMessage(package, f)
+        return
+      for chunk_pb in self.PackageChunks():
+        text_format.PrintMessage(chunk_pb, f)
+
+  def WriteDesignToProto(self, filename, package=None):
+    """Writes the design as a binary circuit proto.
+
+    By default the design is converted and written one module at a time. A
+    prebuilt package is serialised in one piece, which needs memory for the
+    package and its bytes."""
+    with open(filename, 'wb', buffering=1 << 20) as f:
+      if package is not None:
+        f.write(package.SerializeToString())
+        return
+      for chunk_pb in self.PackageChunks():
+        f.write(chunk_pb.SerializeToString())
+
+  def WriteDesignToProtoAndTextProto(self, filename, text_filename):
+    """Writes both formats while converting the design only once."""
+    with open(filename, 'wb', buffering=1 << 20) as f, open(
+        text_filename, 'w', buffering=1 << 20) as text_f:
+      for chunk_pb in self.PackageChunks():
+        f.write(chunk_pb.SerializeToString())
+        text_format.PrintMessage(chunk_pb, text_f)
 
   @staticmethod 
   def FromPortDirection(direction):
-    try:
-      return CircuitWriter.PB_TO_CIRCUIT_PORT_DIRECTION_MAP[direction]
-    except KeyError:
+    circuit_direction = CircuitWriter.PB_TO_CIRCUIT_PORT_DIRECTION_MAP.get(
+        direction)
+    if circuit_direction is None:
       raise Exception(f'Unknown port direction: {direction}')
+    return circuit_direction
 
   @staticmethod
-  def GetKnownSignal(signal_name, known_signals={}):
-    if signal_name not in known_signals:
+  def GetKnownSignal(signal_name, known_signals):
+    signal = known_signals.get(signal_name)
+    if signal is None:
       raise Exception(f'Signal name is not known: {signal_name}')
-    return known_signals[signal_name]
+    return signal
 
   @staticmethod
   def FromSignal(signal_pb):
-    signal_name = signal_pb.name
+    # As in Module.GetOrCreateSignal, names are interned because each is
+    # repeated across signals, ports and connections.
+    signal_name = sys.intern(signal_pb.name)
     return circuit.Signal(signal_name, width=signal_pb.width)
 
   @staticmethod
-  def FromSlice(slice_pb, known_signals={}):
+  def FromSlice(slice_pb, known_signals):
     sliceyboi = circuit.Slice()
     signal_name = slice_pb.signal
     sliceyboi.signal = CircuitWriter.GetKnownSignal(signal_name, known_signals)
@@ -219,7 +319,7 @@ class CircuitWriter():
     return sliceyboi
 
   @staticmethod
-  def FromPort(port_pb, known_signals={}):
+  def FromPort(port_pb, known_signals):
     # Ports represent signals implicitly
     port = circuit.Port()
     port.signal = CircuitWriter.GetKnownSignal(port_pb.signal, known_signals)
@@ -259,10 +359,12 @@ class CircuitWriter():
 
   @staticmethod
   def FromSIPrefix(prefix_pb):
-    try:
-      return CircuitWriter.PB_TO_CIRCUIT_SI_PREFIX_MAP[prefix_pb]
-    except KeyError:
-      raise Exception('Unknown SI prefix: {prefix_pb}')
+    # Every proto prefix maps to an SIUnitPrefix, so None means there was no
+    # entry.
+    prefix = CircuitWriter.PB_TO_CIRCUIT_SI_PREFIX_MAP.get(prefix_pb)
+    if prefix is None:
+      raise Exception(f'Unknown SI prefix: {prefix_pb}')
+    return prefix
 
   @staticmethod
   def FromParameter(param_pb):
@@ -285,43 +387,45 @@ class CircuitWriter():
     raise Exception(f'Cannot interpret Parameter {param_pb}')
 
   @staticmethod
-  def FromConnection(port_name, conn_pb, known_signals={}):
+  def FromConnection(port_name, conn_pb, known_signals):
     connection = circuit.Connection(port_name)
-    referenced_signals = []
     target = conn_pb.target
     set_field = target.WhichOneof('stype')
     if set_field is None:
       return None
     if set_field == 'sig':
-      connection.signal = CircuitWriter.GetKnownSignal(conn_pb.target.sig, known_signals)
-      referenced_signals.append(connection.signal)
+      # This runs for nearly every pin in the design, so GetKnownSignal is
+      # inlined.
+      signal = known_signals.get(target.sig)
+      if signal is None:
+        raise Exception(f'Signal name is not known: {target.sig}')
+      connection.signal = signal
     elif set_field == 'slice':
-      connection.slice = CircuitWriter.FromSlice(conn_pb.target.slice, known_signals)
+      connection.slice = CircuitWriter.FromSlice(target.slice, known_signals)
       connection.slice.Connect(connection)
-      referenced_signals.append(connection.slice.signal)
     elif set_field == 'concat':
       raise Exception('Can\'t deal with concat types yet')
     else:
       raise Exception(f'Unknown field set in Connection proto: {set_field}')
-    return connection, referenced_signals
+    return connection
 
   @staticmethod
-  def FromInstance(instance_pb, known_signals={}):
+  def FromInstance(instance_pb, known_signals):
     instance = circuit.Instance()
     instance.name = instance_pb.name
     set_field = instance_pb.module.WhichOneof('to')
     if set_field == 'local':
-      instance.module_name = instance_pb.module.local
+      instance.module_name = sys.intern(instance_pb.module.local)
     elif set_field == 'external':
-      instance.module_name = instance_pb.module.external.name
+      instance.module_name = sys.intern(instance_pb.module.external.name)
     else:
       raise Exception('Instance does not have module reference set')
     for param_pb in instance_pb.parameters:
       name = param_pb.name
       instance.parameters[name] = CircuitWriter.FromParameter(param_pb)
     for conn_pb in instance_pb.connections:
-      port_name = conn_pb.portname
-      connection, _ = CircuitWriter.FromConnection(port_name, conn_pb, known_signals)
+      port_name = sys.intern(conn_pb.portname)
+      connection = CircuitWriter.FromConnection(port_name, conn_pb, known_signals)
       connection.instance = instance
       slice_or_signal = connection.signal or connection.slice
       slice_or_signal.Connect(connection)
@@ -357,26 +461,44 @@ class CircuitWriter():
         continue
       design.external_modules[module.name] = module
 
+    # Resolve every instance's module with one lookup. Later entries win, so
+    # primitives take precedence over known modules, and those over external
+    # ones. (Primitives are marked passive where they are defined.)
+    all_modules = {
+        **design.external_modules,
+        **design.known_modules,
+        **circuit.PRIMITIVE_MODULES,
+    }
     for module_name, module in design.known_modules.items():
       for instance_name, instance in module.instances.items():
         instance_of = instance.module_name
-        referenced = None
-        if instance_of in circuit.PRIMITIVE_MODULES:
-          referenced = circuit.PRIMITIVE_MODULES[instance_of]
-          # TODO(growly): This might not be true for all primitive modules.
-          referenced.is_passive = True
-        elif instance_of in design.known_modules:
-          referenced = design.known_modules[instance_of]
-        elif instance_of in design.external_modules:
-          referenced = design.external_modules[instance_of]
-        else:
+        referenced = all_modules.get(instance_of)
+        if referenced is None:
           raise Exception(
               f'Instance {instance_name} of module {module_name} refers '
               f'instantiates unknown module {instance_of}')
         instance.module = referenced
 
 
-  def ReadProtoToDesign(self, filename):
+  def ReadProtoToDesign(self, filename, cache_dir=None):
+    # Rebuilding the design from a big proto is slow, and the same file tends to
+    # be loaded over and over. If asked, keep the resulting modules pickled in
+    # 'cache_dir', keyed by the file's path, modification time and size, and
+    # the version of the pickled format.
+    cache_file = None
+    if cache_dir is not None:
+      stat = os.stat(filename)
+      key = hashlib.blake2b(repr(
+          (DESIGN_CACHE_VERSION, pickle.HIGHEST_PROTOCOL,
+           os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)).encode())
+      cache_file = os.path.join(cache_dir, f'{key.hexdigest()}.pkl')
+      if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+          known_modules, external_modules = pickle.load(f)
+        self.design.known_modules.update(known_modules)
+        self.design.external_modules.update(external_modules)
+        return
+
     package_pb = circuit_pb.Package()
 
     with open(filename, 'rb') as f:
@@ -384,4 +506,32 @@ class CircuitWriter():
 
     self.FromCircuitProto(package_pb)
 
+    if cache_file is not None:
+      self.WriteDesignCache(cache_dir, cache_file)
+
+  def WriteDesignCache(self, cache_dir, cache_file):
+    # Write to a temporary file first so that an interrupted or failed write
+    # never leaves a truncated entry behind.
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+      # Primitives are shared module-level singletons, which the design keeps
+      # and instances are pointed back at when unpickled; leave them out so
+      # that a cache hit doesn't replace them with copies.
+      external_modules = {
+          name: module
+          for name, module in self.design.external_modules.items()
+          if name not in circuit.PRIMITIVE_MODULES}
+      with os.fdopen(fd, 'wb') as f:
+        pickle.dump((self.design.known_modules, external_modules),
+                    f, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(temp_file, cache_file)
+    except NotImplementedError as e:
+      # Modules with connections we can't pickle (concats) just aren't cached.
+      log.warning('not caching design in %s: %s', cache_dir, e)
+      os.remove(temp_file)
+    except:
+      os.remove(temp_file)
+      raise
+
 
@@ -1,18 +1,19 @@
 # vim: set shiftwidth=2 softtabstop=2 ts=2 expandtab:
 
-import optparse
+import concurrent.futures
+import contextlib
 import os
 import collections
 import math
 from enum import Enum
-from optparse import OptionParser
+import logging
 import re
 
 import circuit
-import circuit_writer
 import spef
 import spice
-import spice_analyser
+
+log = logging.getLogger(__name__)
 
 
 class Design():
@@ -38,19 +39,31 @@ class Design():
     except:
       return None
 
-  def ParseVerilog(self, verilog_files, include_paths, defines):
+  def ParseVerilog(self, verilog_files, include_paths, defines,
+                   use_yosys=False, cache_dir=None, jobs=1):
     from verilog import DesignReader
-    return DesignReader.ParseVerilog(
+    parse = DesignReader.ParseVerilog
+    # The Yosys reader is opt-in until it handles everything the pyverilog one
+    # does.
+    if use_yosys:
+      if DesignReader.YosysAvailable():
+        parse = DesignReader.ParseVerilogFast
+      else:
+        log.warning('yosys not found; falling back to pyverilog to read '
+                    'verilog')
+    return parse(
       design=self,
       verilog_files=verilog_files, 
       include_paths=include_paths, 
-      defines=defines
+      defines=defines,
+      cache_dir=cache_dir,
+      jobs=jobs
     )
 
   def Link(self):
     # At this point, every module we should know about should be available to us.
     # Replace every unknown reference with a black box.
-    for name, instances in self.unknown_references.items():
+    for name, instances in list(self.unknown_references.items()):
       if name in self.known_modules:
         # Module has since been loaded.
         internal_module = self.known_modules[name]
@@ -73,61 +86,107 @@ class Design():
       # external_module.GuessPorts(instances)
       self.external_modules[name] = external_module
 
-    for module in self.known_modules.values():
-      for _, instance in module.instances.items():
+    # One lookup per instance instead of two. Known modules take precedence
+    # over external ones of the same name.
+    modules_by_name = {**self.external_modules, **self.known_modules}
+    Connection = circuit.Connection
+    Slice = circuit.Slice
+    # Only complain once about each module without a port order.
+    warned_modules = set()
+    for parent in self.known_modules.values():
+      for instance in parent.instances.values():
         ref_name = instance.module_name
-        module = None
-        if ref_name in self.known_modules:
-          module = self.known_modules[ref_name]
-        elif ref_name in self.external_modules:
-          module = self.external_modules[ref_name]
-        else:
+        module = modules_by_name.get(ref_name)
+        if module is None:
           raise Exception('instance references module which should be known or '
                           'external, but is neither: {}'.format(ref_name))
 
         # Internal or external, we need one of those objects here.
         instance.module = module
 
-        for i, signal in enumerate(instance.connections_by_order):
-          if not module.port_order:
-            print(f'warning: instance {instance.name} is of {instance.module_name} '
-                  f'which has no known port_order')
+        connections_by_order = instance.connections_by_order
+        if not connections_by_order:
+          continue
+        port_order = module.port_order
+        if not port_order:
+          if ref_name not in warned_modules:
+            warned_modules.add(ref_name)
+            log.warning('instance %s is of %s which has no known port_order',
+                        instance.name, ref_name)
+          continue
+
+        # Use the ordered connections to connect up ports, now that we know
+        # what the master Module is.
+        # Entries are Signals or Slices, or None for arguments that connect to
+        # nothing.
+        connections = instance.connections
+        for port_name, target in zip(port_order, connections_by_order):
+          if target is None:
             continue
-          # Use the ordered connections to connect up ports, now that we know
-          # what the master Module is.
-          try:
-              port_name = module.port_order[i]
-          except IndexError:
-              print(f'warning: instance {instance.name} of module '
-                    f'{instance.module_name} has too many connections; signal '
-                    f'{signal} will not be connected')
-              known_ports = ', '.join(module.port_order)
-              connections = ', '.join(
-                  x.name for x in instance.connections_by_order)
-              print(f'\tknown ports: {known_ports}\n'
-                    f'\tinstance connections: {connections}')
-              continue
-
-          connection = circuit.Connection(port_name)
-          connection.signal = signal
+          connection = Connection(port_name)
+          if isinstance(target, Slice):
+            connection.slice = target
+          else:
+            connection.signal = target
           connection.instance = instance
-          instance.connections[port_name] = connection
-
-  def ParseSPEF(self, spef_files):
-    for f in spef_files:
-      spef_reader = spef.SPEFReader('VSS')
-      module = spef_reader.ReadSPEF(f)
+          target.Connect(connection)
+          connections[port_name] = connection
+        instance.outgoing_connections = None
+
+        if len(connections_by_order) > len(port_order):
+          unconnected = ', '.join(
+              str(x) for x in connections_by_order[len(port_order):])
+          known_ports = ', '.join(port_order)
+          connection_names = ', '.join(
+              x.name if isinstance(x, circuit.Signal) else str(x)
+              for x in connections_by_order)
+          log.warning('instance %s of module %s has too many connections; '
+                      'signals %s will not be connected\n'
+                      '\tknown ports: %s\n'
+                      '\tinstance connections: %s',
+                      instance.name, ref_name, unconnected, known_ports,
+                      connection_names)
+
+  @contextlib.contextmanager
+  def SPEFReaders(self, spef_files, jobs=1):
+    """Yields an iterator over SPEFReaders for spef_files, in order.
+
+    With jobs > 1, the files are tokenised in worker processes, starting
+    straight away, so other work in the with-block overlaps with reading them.
+    """
+    if jobs > 1 and len(spef_files) > 1:
+      with concurrent.futures.ProcessPoolExecutor(
+          max_workers=min(jobs, len(spef_files))) as executor:
+        yield executor.map(spef.SPEFReader.FromFile, spef_files)
+    else:
+      yield (spef.SPEFReader.FromFile(f) for f in spef_files)
+
+  def ParseSPEF(self, spef_files, jobs=1):
+    # Modules are built and merged here, in order, since merging mutates the
+    # design. Each file is merged as soon as it has been read, while any
+    # workers carry on with the rest.
+    with self.SPEFReaders(spef_files, jobs=jobs) as spef_readers:
+      self.AddSPEFReaders(spef_readers)
+
+  def AddSPEFReaders(self, spef_readers):
+    # Take readers one at a time so that only one file's worth of them is held
+    # at once.
+    for spef_reader in spef_readers:
+      module = spef_reader.ToModule()
+      # The reader's tables are about as big as the Module built from them and
+      # aren't needed for the merge, so free them first.
+      del spef_reader
       self.AddModuleFromSPEF(module)
 
   def AddModuleFromSPEF(self, module):
     if module.name in self.known_modules:
       # Have to do a merge/verification.
-      print(f'merging module: {module.name}')
+      log.info('merging module: %s', module.name)
       existing = self.known_modules[module.name]
       self.MergeSPEFIntoVerilogModule(existing, module)
       del module
     else:
-      print(f'adding module: {module.name}')
+      log.info('adding module: %s', module.name)
       self.known_modules[module.name] = module
 
   def CheckPowerAndGround(self):
@@ -135,9 +194,12 @@ class Design():
     # TODO(growly): This needs to be a bit more robust. User should specify
     # what the power and ground nets are. Additionally, there may be other
     # implicit signals which we should be able to discover: clk, rst, etc.
+    implicit_nets = self.power_net_names + self.ground_net_names
     for module_name, module in self.known_modules.items():
-      for net in self.power_net_names + self.ground_net_names:
-        if net in module.signals and not net in module.ports:
+      signals = module.signals
+      ports = module.ports
+      for net in implicit_nets:
+        if net in signals and net not in ports:
           print(f'creating {module_name} port for implicit net: {net}')
           signal = module.GetOrCreateSignal(net)
           new_port = circuit.Port()
@@ -149,6 +211,9 @@ class Design():
 
   def MergeSPEFIntoVerilogModule(self, verilog_module, spef_module):
     assert(verilog_module.name == spef_module.name)
+    # Formatting Signals and Instances is expensive; only do it when it will be
+    # seen.
+    debug = log.isEnabledFor(logging.DEBUG)
     # When trying to match components of one module to the other, there is the
     # general problem of graph isomorphism here which we will conveniently
     # avoid.
@@ -246,28 +311,42 @@ class Design():
       return connection
 
     # Merge signals.
-    for name, new in spef_module.signals.items():
-      if name in verilog_module.signals:
-        existing = verilog_module.signals[name]
-        if existing.width != new.width:
-          raise SPEFBadAssumption(
-              f'merging in signal {name} with different width {new.width} vs '
-              '{existing.width}')
-        #existing = verilog_module.signals[name]
-        #existing.Disconnect()
-        #del verilog_module.signals[name]
-        print(f'existing {existing}')
-        unseen_signals.remove(name)
-      elif new.parent_name and new.parent_name in verilog_module.signals:
-        existing = verilog_module.signals[new.parent_name]
+    verilog_signals = verilog_module.signals
+    spef_signals = spef_module.signals
+    GetOrCreateSignal = verilog_module.GetOrCreateSignal
+
+    # Signals named in both modules only need their widths checked.
+    common = spef_signals.keys() & verilog_signals.keys()
+    for name in common:
+      existing = verilog_signals[name]
+      new = spef_signals[name]
+      if existing.width != new.width:
+        raise spef.SPEFBadAssumption(
+            f'merging in signal {name} with different width {new.width} vs '
+            f'{existing.width}')
+      #existing.Disconnect()
+      #del verilog_module.signals[name]
+      if debug:
+        log.debug('existing %s', existing)
+    unseen_signals -= common
+
+    # The rest are new. Walk them in SPEF order so that signals are created
+    # deterministically.
+    for name, new in spef_signals.items():
+      if name in common:
+        continue
+      # Check the live dict, not a snapshot: parents can be deleted as we go.
+      if new.parent_name and new.parent_name in verilog_signals:
+        existing = verilog_signals[new.parent_name]
         # Disconnect from everything that isn't a port. This leaves the signal as
         # known so that we can create slices (references) to it again.
-        print(f'disconnecting {existing}')
+        if debug:
+          log.debug('disconnecting %s', existing)
         existing.Disconnect()
         if existing.ports is None:
           # Replace existing signal's parent.
-          print(f'deleting parent signal: {new.parent_name}')
-          del verilog_module.signals[new.parent_name]
+          log.debug('deleting parent signal: %s', new.parent_name)
+          del verilog_signals[new.parent_name]
         else:
           # TODO(growly): This is a bit of a hack. See one of my essays in the
           # comments. Probably need to make SPEF extractor aware of slices. What
@@ -277,35 +356,45 @@ class Design():
           # schema yet, though.
           pass
         # Stand up a reference to the new signal.
-        copied_in = verilog_module.GetOrCreateSignal(name)
+        copied_in = GetOrCreateSignal(name)
         copied_in.width = new.width
-        print(f'new {copied_in} replaces {new.parent_name}')
+        if debug:
+          log.debug('new %s replaces %s', copied_in, new.parent_name)
         # Keep track of which signals we have in the existing module but that
         # we don't see in the new circuit.
-        if new.parent_name in unseen_signals:
-          unseen_signals.remove(new.parent_name)
-      else:
-        signal = verilog_module.GetOrCreateSignal(name)
-        print(f'new {signal}')
-        
-    # Merge instances.
-    for name, new in spef_module.instances.items():
-      if name in verilog_module.instances:
-        modify = verilog_module.instances[name]
-        modify.parameters.update(new.parameters)
-        print(f'existing [{name}] {modify}')
-        if modify.module_name != new.module_name:
-          raise Exception(
-              f'merging in instance {name} with different module type '
-              f'{new.module_name} vs {modify.module_name}')
-        unseen_instances.remove(name)
+        unseen_signals.discard(new.parent_name)
       else:
-        modify = circuit.Instance()
-        modify.name = new.name
-        modify.module_name = new.module_name
-        modify.parameters.update(new.parameters)
-        print(f'new {modify}')
-        verilog_module.instances[name] = modify
+        signal = GetOrCreateSignal(name)
+        if debug:
+          log.debug('new %s', signal)
+
+    # Merge instances. As with signals, instances in both modules are only
+    # checked and updated; the rest are copied in, in SPEF order.
+    verilog_instances = verilog_module.instances
+    spef_instances = spef_module.instances
+    common_instances = spef_instances.keys() & verilog_instances.keys()
+    for name in common_instances:
+      new = spef_instances[name]
+      modify = verilog_instances[name]
+      modify.parameters.update(new.parameters)
+      if debug:
+        log.debug('existing [%s] %s', name, modify)
+      if modify.module_name != new.module_name:
+        raise Exception(
+            f'merging in instance {name} with different module type '
+            f'{new.module_name} vs {modify.module_name}')
+    unseen_instances -= common_instances
+
+    for name, new in spef_instances.items():
+      if name in common_instances:
+        continue
+      modify = circuit.Instance()
+      modify.name = new.name
+      modify.module_name = new.module_name
+      modify.parameters.update(new.parameters)
+      if debug:
+        log.debug('new %s', modify)
+      verilog_instances[name] = modify
 
     # Elaborate connections among instances with all signals and instances now
     # merged.
@@ -319,14 +408,22 @@ class Design():
         if port_name in existing.connections:
           existing_connection = existing.connections[port_name]
           # Remove references to this connection in the parent slice/signal.
-          print(f'removing connection {existing_connection} from parent {existing_connection.instance.connections}')
+          if debug:
+            log.debug('removing connection %s from parent %s',
+                      existing_connection,
+                      existing_connection.instance.connections)
           existing_connection.DisconnectFromParent(include_ports=True)
           # Remove this connection from the existing instance.
           existing_connection.Disconnect()
-          print(f'existing {name} port {port_name} reconnected to {new_connection}')
+          if debug:
+            log.debug('existing %s port %s reconnected to %s',
+                      name, port_name, new_connection)
         else:
-          print(f'new {name} port {port_name} connection to {new_connection}')
+          if debug:
+            log.debug('new %s port %s connection to %s',
+                      name, port_name, new_connection)
         existing.connections[port_name] = new_connection
+      existing.outgoing_connections = None
 
     # Do not count implicit nets as 'unseen', since we'll never see them, by
     # definition.
@@ -336,16 +433,16 @@ class Design():
     # Prune signals that may have been replaced without much mention:
     # NOTE(growly): if we assumed that nets were described 1:1, we could do this
     # immediately, since we'd know that a *D_NET existing for each net, say.
-    for name in list(unseen_signals):
-      signal = verilog_module.signals[name]
-      if not signal.ConnectsAnything:
-        print(f'pruning {signal}')
-        del verilog_module.signals[name]
-        unseen_signals.remove(name)
-        continue
+    unconnected = [name for name in unseen_signals
+                   if not verilog_signals[name].ConnectsAnything]
+    for name in unconnected:
+      if debug:
+        log.debug('pruning %s', verilog_signals[name])
+      del verilog_signals[name]
+    unseen_signals.difference_update(unconnected)
 
-    print('unseen signals in merged-in Module: {}'.format(unseen_signals))
-    print('unseen instances in merged-in Module: {}'.format(unseen_instances))
+    log.debug('unseen signals in merged-in Module: %s', unseen_signals)
+    log.debug('unseen instances in merged-in Module: %s', unseen_instances)
 
   def ParseSpiceDefinitions(self, spice_files, headers_only=False):
     for file_name in spice_files:
@@ -376,8 +473,8 @@ class Design():
         for subckt in parser.subckts:
           module = subckt.ToModule(self)
           if module.name in self.known_modules:
-              print(f'warning: multiple definitions for subckt {module.name}, '
-                    f'overwriting previous')
+              log.warning('multiple definitions for subckt %s, overwriting '
+                          'previous', module.name)
           self.known_modules[module.name] = module
 
           for instance in module.instances.values():
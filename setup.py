@@ -21,10 +21,25 @@ https://github.com/pypa/sampleproject/blob/main/setup.py
 
 # Always prefer setuptools over distutils
 from setuptools import setup, find_packages
+import os
 import pathlib
 
 here = pathlib.Path(__file__).parent.resolve()
 
+# Optionally compile the netlist object model, the SPEF reader and the circuit
+# proto reader/writer, where most of the time on large designs is spent, with
+# Cython. These are ordinary Python modules; Cython compiles them as-is and the
+# result is a drop-in replacement.
+#   BIGSPICY_CYTHONIZE=1 python setup.py build_ext --inplace
+ext_modules = []
+if os.environ.get("BIGSPICY_CYTHONIZE"):
+    from Cython.Build import cythonize
+
+    ext_modules = cythonize(
+        ["circuit.py", "spef.py", "circuit_writer.py"],
+        compiler_directives={"language_level": 3},
+    )
+
 # Get the long description from the README file
 long_description = (here / "README.md").read_text(encoding="utf-8")
 
@@ -39,6 +54,7 @@ setup(
     author="Arya Reais-Parsi",
     author_email="growly@google.com",
     packages=find_packages(),
+    ext_modules=ext_modules,
     ##python_requires=">=3.8, <4",
     install_requires=["pyverilog", "numpy", "matplotlib", "protobuf>4.21"],
     extras_require={
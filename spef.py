@@ -16,6 +16,7 @@
 
 import re
 import collections
+import sys
 from enum import Enum
 
 from spice_util import NumericalValue, SIUnitPrefix
@@ -227,11 +228,26 @@ class SPEFReader():
       out += '\t{}: {}\n'.format(net, net_info)
     return out
 
-  def ReadSPEF(self, filename):
+  @staticmethod
+  def FromFile(filename, implicit_ground_net='VSS'):
+    """Read a SPEF file into a new SPEFReader without building a Module.
+
+    The reader's state is plain dicts of nodes and values, so unlike the
+    Module it is cheap to pickle; this is what lets files be read in worker
+    processes.
+    """
+    reader = SPEFReader(implicit_ground_net)
+    reader.Read(filename)
+    return reader
+
+  def Read(self, filename):
     with open(filename) as f:
       for line in f:
         SPEFReader.COMMENT_RE.sub('', line)
         self.ReadLine(line)
+
+  def ReadSPEF(self, filename):
+    self.Read(filename)
     return self.ToModule()
 
   def ReadLine(self, line):
@@ -404,12 +420,13 @@ class SPEFReader():
   # MAJx3 instance, and for 'C' to be a named port on that instance, too.
   def ReadConn(self, tokens):
     node = None
+    tokens = collections.deque(tokens)
     while tokens:
-      keyword = tokens.pop(0)
+      keyword = tokens.popleft()
       if keyword == '*I':
         # Name of net connected to this one, direction
-        name = tokens.pop(0)
-        direction = tokens.pop(0)
+        name = tokens.popleft()
+        direction = tokens.popleft()
         node = self.DigestNodeReference(name)
         node.connection_to_nets.add(self.current_net)
         #TODO(growly): What is this doing?
@@ -424,7 +441,7 @@ class SPEFReader():
         # Driving cell
         if node is None:
           raise SPEFBadAssumption('Assume *I would define node name before we saw *D')
-        node.cell_type = tokens.pop(0)
+        node.cell_type = tokens.popleft()
       elif keyword == '*L':
         # Loading cell
         pass
@@ -580,7 +597,7 @@ class SPEFReader():
       else:
         instance = circuit.Instance()
         instance.name = instance_name
-        instance.module_name = node.cell_type
+        instance.module_name = sys.intern(node.cell_type)
         module.instances[instance_name] = instance
       # The node we're inspecting should be a unique reference to a port on the
       # instance, which we model by creating a Connection to the eponymous Port
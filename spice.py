@@ -19,12 +19,17 @@ from datetime import datetime
 import time
 from spice_util import NumericalValue, SIUnitPrefix
 from enum import Enum
+import io
 import os
 import re
+import sys
 
 
 SPLIT_KEEPING_PARAMS_RE = re.compile(r'(?<!=)\s+(?!=)')
 
+# Netlists are written in many small pieces; buffer them in large chunks.
+OUTPUT_BUFFER_SIZE = 1 << 20
+
 
 class GeneralWhoopsieDaisy(Exception):
   pass
@@ -72,7 +77,7 @@ class SpiceSubckt():
       instance = circuit.Instance()
       instance.name = spice_inst.name
       module.instances[instance.name] = instance
-      instance.module_name = spice_inst.module_name
+      instance.module_name = sys.intern(spice_inst.module_name)
 
       for param in spice_inst.params:
         key, value = param.split('=')
@@ -234,19 +239,31 @@ class SpiceReader():
 
     state = SpiceReader.State.NONE
     lines = []
+    # When only reading headers, whether we're still in the .subckt line and
+    # its continuations.
+    in_header = False
 
     with open(file_name) as f:
       for line in f:
         if not line:
           continue
 
-        tokens = line.split()
+        # Only the first token is needed, so don't split the whole line.
+        tokens = line.split(None, 1)
         if not tokens:
           continue
-        spice_command = tokens.pop(0).lower()
+        spice_command = tokens[0].lower()
 
         if state == SpiceReader.State.SUBCKT:
-          lines.append(line)
+          if not self.headers_only or spice_command == '.ends':
+            lines.append(line)
+          elif in_header:
+            # Subckt bodies can be huge and their contents are ignored when
+            # only reading headers, so stop collecting lines after the header.
+            if spice_command.startswith('+'):
+              lines.append(line)
+            elif not spice_command.startswith('*'):
+              in_header = False
           if spice_command == '.ends':
             subckt = self.ParseSubckt(lines)
             lines = []
@@ -271,6 +288,7 @@ class SpiceReader():
         elif spice_command == '.subckt':
           lines = [line]
           state = SpiceReader.State.SUBCKT
+          in_header = True
 
   def Read(self, file_name):
     file_names = set([file_name])
@@ -462,14 +480,21 @@ class SpiceWriter():
                                      prefix=instance.name, generate_names=True) + '\n'
     return out
 
-  def FormatInstances(self, instances, generate_names=False):
-    out = ''
+  def WriteInstances(self, f, instances, generate_names=False):
+    # Write instances out one by one rather than building the whole netlist up
+    # as a single string first.
+    write = f.write
     for instance in instances:
       if self.flatten and type(instance.module) is circuit.Module:
-        out += f'{self.FlattenedInstance(instance)}\n'
+        write(self.FlattenedInstance(instance))
       else:
-        out += f'{self.SpiceInstantiation(instance, generate_names=generate_names)}\n'
-    return out
+        write(self.SpiceInstantiation(instance, generate_names=generate_names))
+      write('\n')
+
+  def FormatInstances(self, instances, generate_names=False):
+    out = io.StringIO()
+    self.WriteInstances(out, instances, generate_names=generate_names)
+    return out.getvalue()
 
   def WriteRegion(self, file_name, region, generate_names=False):
     # Ports have to be defined somehow. For now let's assume we have some in
@@ -485,7 +510,8 @@ class SpiceWriter():
       pin_names.append(pin.SpiceName())
 
     instances = sorted(list(instance_set), key=lambda x: x.name)
-    with open(file_name, 'w') as f:
+    self._ResetCounters()
+    with open(file_name, 'w', buffering=OUTPUT_BUFFER_SIZE) as f:
       f.write('** SPICE netlist generated by bigspicy.py at '
               f'{datetime.utcnow().ctime()} UTC\n')
       f.write(f'** {len(instance_set)} instances; '
@@ -495,7 +521,7 @@ class SpiceWriter():
       f.write(f'.SUBCKT {region.name}\n')
       f.write('+ ' + ' '.join(pin_names) + '\n')
 
-      f.write(self.FormatInstances(instances, generate_names=generate_names))
+      self.WriteInstances(f, instances, generate_names=generate_names)
 
       f.write('.ENDS\n')
 
@@ -505,12 +531,13 @@ class SpiceWriter():
     self.WriteModule(self.design.top, file_name)
 
   def WriteModule(self, module, file_name):
-    with open(file_name, 'w') as f:
+    self._ResetCounters()
+    with open(file_name, 'w', buffering=OUTPUT_BUFFER_SIZE) as f:
       f.write('** SPICE netlist generated by bigspicy.py at '
               f'{datetime.utcnow().ctime()} UTC\n')
       f.write(f'.SUBCKT {module.name}\n')
       f.write(f'+ {self.ModulePortList(module)}\n')
-      f.write(self.FormatInstances(module.instances.values()))
+      self.WriteInstances(f, module.instances.values())
       f.write('.ENDS\n')
 
 
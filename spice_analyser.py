@@ -22,9 +22,6 @@ from enum import Enum
 from datetime import datetime
 import numpy as np
 import math
-import matplotlib.pyplot as plt
-
-import pdb
 
 import os
 import circuit
@@ -891,6 +888,9 @@ class SpiceAnalyser:
 
 
   def ReportWholeModuleInputRamps(self):
+    # matplotlib is slow to import and only needed for these plots.
+    import matplotlib.pyplot as plt
+
     # Separate regions from the module test:
     sub_regions = []
     whole_module_regions = []
@@ -995,12 +995,12 @@ class SpiceAnalyser:
           headers.add(tag)
         rows.append(row)
 
-    with open(csv_file_name, 'w') as f:
+    with open(csv_file_name, 'w', newline='',
+              buffering=spice.OUTPUT_BUFFER_SIZE) as f:
       field_names = ['source', 'sink'] + sorted(headers)
       csv_writer = csv.DictWriter(f, field_names)
       csv_writer.writeheader()
-      for row in rows:
-        csv_writer.writerow(row)
+      csv_writer.writerows(rows)
 
   def _FindSmallSignalInputCapacitance(self, region):
     results = region.linear_analyses
@@ -1169,12 +1169,12 @@ class SpiceAnalyser:
         rows.append(row)
         print(f'{row=}')
 
-    with open(csv_file_name, 'w') as f:
+    with open(csv_file_name, 'w', newline='',
+              buffering=spice.OUTPUT_BUFFER_SIZE) as f:
       field_names = ['module_name'] + sorted(headers)
       csv_writer = csv.DictWriter(f, field_names)
       csv_writer.writeheader()
-      for row in rows:
-        csv_writer.writerow(row)
+      csv_writer.writerows(rows)
 
   def _AddSmallSignalInputCapacitanceTest(self, module, region, subckt_file):
     # NOTE(growly): A brief "hand-" study of the input capacitance of pin A
@@ -0,0 +1,99 @@
+# vim: set shiftwidth=2 softtabstop=2 ts=2 expandtab:
+#
+#    Copyright 2022 Google LLC
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+import sys
+
+import pytest
+
+# The bigspicy modules live at the top of the repository rather than in a
+# package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# Two modules, one instantiating the other with positional arguments.
+_WRAPPED_VERILOG = '''
+module leaf (a, b, y);
+  input a;
+  input b;
+  output y;
+  wire nand_out;
+  NAND2 n0 (.A(a), .B(b), .Y(nand_out));
+  INV i0 (.A(nand_out), .Y(y));
+endmodule
+
+module wrapper (a, b, y);
+  input a;
+  input b;
+  output y;
+  leaf m0 (a, b, y);
+endmodule
+'''
+
+
+@pytest.fixture(scope='session')
+def verilog_parser(tmp_path_factory):
+  """Parses Verilog source text with pyverilog.
+
+  This skips pyverilog's preprocessor, which needs iverilog installed. """
+  from pyverilog.vparser.parser import VerilogParser
+  parser = VerilogParser(
+      outputdir=str(tmp_path_factory.mktemp('pyverilog')), debug=False)
+  return parser.parse
+
+
+@pytest.fixture
+def wrapped_verilog():
+  return _WRAPPED_VERILOG
+
+
+def _SummariseModule(module):
+  """Describes a Module's netlist with plain values, for comparisons."""
+  def Entity(entity):
+    if entity.__class__.__name__ == 'Port':
+      return f'port {entity.name}'
+    return f'connection {entity.instance.name}/{entity.port_name}'
+
+  ports = {
+      name: (port.name, port.direction, port.signal.name)
+      for name, port in module.ports.items()}
+  signals = {
+      name: (signal.name, signal.width, {
+          index: sorted(Entity(entity) for entity in entities)
+          for index, entities in signal.connects.items()})
+      for name, signal in module.signals.items()}
+  instances = {}
+  for name, instance in module.instances.items():
+    connections = {}
+    for port_name, connection in instance.connections.items():
+      if connection.slice is not None:
+        connections[port_name] = (connection.slice.signal.name,
+                                  connection.slice.top,
+                                  connection.slice.bottom)
+      else:
+        connections[port_name] = (connection.signal.name, None, None)
+    by_order = [
+        (target.signal.name, target.top, target.bottom)
+        if target.__class__.__name__ == 'Slice' else
+        getattr(target, 'name', None)
+        for target in instance.connections_by_order]
+    instances[name] = (instance.module_name, connections, by_order)
+  return (module.name, module.port_order, ports, signals, instances)
+
+
+@pytest.fixture
+def summarise_module():
+  return _SummariseModule
@@ -0,0 +1,173 @@
+# vim: set shiftwidth=2 softtabstop=2 ts=2 expandtab:
+#
+#    Copyright 2022 Google LLC
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import logging
+import pickle
+import sys
+import threading
+
+import circuit
+from design import Design
+from verilog import DesignReader
+
+
+def _ReadModules(verilog_parser, source):
+  return [circuit.Module.FromVerilog(node)
+          for node in DesignReader.WalkModuleDefs(verilog_parser(source))]
+
+
+def test_pickle_round_trips_positional_connections(
+    verilog_parser, wrapped_verilog, summarise_module):
+  _, wrapper = _ReadModules(verilog_parser, wrapped_verilog)
+  # Positional arguments are kept in order until the design is linked.
+  assert [signal.name for signal in
+          wrapper.instances['m0'].connections_by_order] == ['a', 'b', 'y']
+
+  copy = pickle.loads(pickle.dumps(wrapper))
+
+  assert summarise_module(copy) == summarise_module(wrapper)
+  assert copy.instances['m0'].connections_by_order == [
+      copy.signals['a'], copy.signals['b'], copy.signals['y']]
+
+
+def test_pickle_round_trips_linked_positional_connections(
+    verilog_parser, wrapped_verilog, summarise_module):
+  design = Design()
+  DesignReader.RegisterModules(
+      design, _ReadModules(verilog_parser, wrapped_verilog))
+  design.Link()
+  wrapper = design.known_modules['wrapper']
+
+  copy = pickle.loads(pickle.dumps(wrapper))
+
+  assert summarise_module(copy) == summarise_module(wrapper)
+  connection = copy.instances['m0'].connections['y']
+  assert connection.signal is copy.signals['y']
+  assert connection in copy.signals['y'].Connects(0)
+  assert copy.ports['y'] in copy.signals['y'].Connects(0)
+
+
+def test_pickle_round_trips_named_connections(
+    verilog_parser, wrapped_verilog, summarise_module):
+  leaf, _ = _ReadModules(verilog_parser, wrapped_verilog)
+
+  copy = pickle.loads(pickle.dumps(leaf))
+
+  assert summarise_module(copy) == summarise_module(leaf)
+
+
+def test_unpickled_names_are_interned(verilog_parser, wrapped_verilog):
+  leaf, _ = _ReadModules(verilog_parser, wrapped_verilog)
+
+  copy = pickle.loads(pickle.dumps(leaf))
+
+  assert copy.instances['n0'].module_name is sys.intern('NAND2')
+  name, = (name for name in copy.signals if name == 'nand_out')
+  assert name is sys.intern('nand_out')
+  assert copy.signals['nand_out'].name is sys.intern('nand_out')
+
+
+def _AttachedRegion(attach):
+  signal = circuit.Signal('bus', width=3)
+  wires = [circuit.Wire(signal, i) for i in range(3)]
+  region = circuit.DesignRegion()
+  region.AttachPorts(wires[:2])
+  existing = dict(region.port_network_ports)
+  region.AttachVoltageProbes(wires[:2])
+  attach(region, wires)
+  return region, wires, existing
+
+
+def test_attach_all_keeps_existing_ports_like_attach_ports():
+  by_parts, wires, parts_existing = _AttachedRegion(
+      lambda region, wires: (region.AttachPorts(wires),
+                             region.AttachVoltageProbes(wires)))
+  at_once, _, existing = _AttachedRegion(
+      lambda region, wires: region.AttachAll(wires, probes=True))
+
+  for region, kept in ((by_parts, parts_existing), (at_once, existing)):
+    assert set(region.port_network_ports) == {w.SpiceName() for w in wires}
+    for name, port in kept.items():
+      assert region.port_network_ports[name] is port
+    assert set(region.voltage_probes) == {w.SpiceName() for w in wires}
+
+
+def test_find_paths_walks_combinational_loops_once(verilog_parser, caplog):
+  # n0 and i0 form a loop through n[0] and n[1].
+  source = '''
+module ring (a, y);
+  input a;
+  output y;
+  wire [1:0] n;
+  NAND2 n0 (.A(a), .B(n[1]), .Y(n[0]));
+  INV i0 (.A(n[0]), .Y(n[1]));
+  INV i1 (.A(n[1]), .Y(y));
+endmodule
+'''
+  design = Design()
+  DesignReader.RegisterModules(design, _ReadModules(verilog_parser, source))
+  design.Link()
+  ring = design.known_modules['ring']
+
+  with caplog.at_level(logging.DEBUG, logger='circuit'):
+    # A daemon thread, so that a search that never ends fails the test instead
+    # of hanging it.
+    search = threading.Thread(target=ring.FindPaths, daemon=True)
+    search.start()
+    search.join(timeout=10)
+  assert not search.is_alive()
+
+  # n[1]'s sinks are a set, so the last two can come in either order.
+  visited = [(record.args[0].instance.name, record.args[0].port_name)
+             for record in caplog.records if record.msg == 'current: %s']
+  assert visited[:2] == [('n0', 'A'), ('i0', 'A')]
+  assert sorted(visited[2:]) == [('i1', 'A'), ('n0', 'B')]
+
+
+def test_signal_counts_its_connections():
+  signal = circuit.Signal('bus', width=2)
+  connection = circuit.Connection('A')
+  assert not signal.ConnectsAnything
+
+  signal.Connect(connection)
+  signal.Connect(connection, index=1)
+  assert signal.num_connects == 2
+  assert signal.ConnectsAnything
+
+  signal.Disconnect(entity=connection)
+  assert signal.num_connects == 0
+  assert not signal.ConnectsAnything
+
+
+def test_enumerate_wires_covers_buses_and_slices():
+  bus = circuit.Signal('bus', width=4)
+  whole = circuit.Connection('A')
+  whole.signal = bus
+  part = circuit.Connection('B')
+  part.slice = circuit.Slice()
+  part.slice.signal = bus
+  part.slice.top = 2
+  part.slice.bottom = 1
+  port = circuit.Port()
+  port.signal = bus
+
+  def Indices(wires):
+    return [(wire.signal.name, wire.index) for wire in wires]
+
+  assert Indices(whole.EnumerateWires()) == [('bus', i) for i in range(4)]
+  assert Indices(part.EnumerateWires()) == [('bus', 1), ('bus', 2)]
+  assert Indices(port.EnumerateWires()) == [('bus', i) for i in range(4)]
+  assert Indices(port.EnumerateWires(low=1, high=3)) == [('bus', 1), ('bus', 2)]
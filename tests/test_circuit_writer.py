@@ -0,0 +1,132 @@
+# vim: set shiftwidth=2 softtabstop=2 ts=2 expandtab:
+#
+#    Copyright 2022 Google LLC
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import logging
+import types
+
+import pytest
+
+# The generated protobuf modules come from the vlsir submodule.
+pytest.importorskip('circuit_pb2')
+pytest.importorskip('utils_pb2')
+
+import circuit
+import circuit_writer
+from circuit_writer import CircuitWriter
+from design import Design
+from verilog import DesignReader
+
+
+@pytest.fixture
+def design_proto(verilog_parser, wrapped_verilog, tmp_path):
+  design = Design()
+  DesignReader.RegisterModules(design, [
+      circuit.Module.FromVerilog(node)
+      for node in DesignReader.WalkModuleDefs(verilog_parser(wrapped_verilog))])
+  design.Link()
+  proto_file = tmp_path / 'design.pb'
+  CircuitWriter(design).WriteDesignToProto(str(proto_file))
+  return str(proto_file)
+
+
+def test_slow_protobuf_warning_is_logged_once(monkeypatch, caplog):
+  monkeypatch.setattr(CircuitWriter, 'warned_slow_protobuf', False)
+  monkeypatch.setattr(
+      circuit_writer.api_implementation, 'Type', lambda: 'python')
+
+  with caplog.at_level(logging.WARNING, logger='circuit_writer'):
+    CircuitWriter(Design())
+    CircuitWriter(Design())
+
+  assert caplog.text.count('pure-Python implementation') == 1
+
+
+def test_read_proto_cache_skips_rebuilding(
+    design_proto, tmp_path, monkeypatch, summarise_module):
+  cache_dir = str(tmp_path / 'cache')
+  first = Design()
+  CircuitWriter(first).ReadProtoToDesign(design_proto, cache_dir=cache_dir)
+
+  def Unexpected(self, package_pb):
+    raise AssertionError('design was rebuilt instead of read from the cache')
+
+  monkeypatch.setattr(CircuitWriter, 'FromCircuitProto', Unexpected)
+  second = Design()
+  CircuitWriter(second).ReadProtoToDesign(design_proto, cache_dir=cache_dir)
+
+  assert ({name: summarise_module(module)
+           for name, module in second.known_modules.items()} ==
+          {name: summarise_module(module)
+           for name, module in first.known_modules.items()})
+
+
+def test_read_proto_cache_is_keyed_on_format_version(
+    design_proto, tmp_path, monkeypatch):
+  cache_dir = tmp_path / 'cache'
+  CircuitWriter(Design()).ReadProtoToDesign(
+      design_proto, cache_dir=str(cache_dir))
+  monkeypatch.setattr(circuit_writer, 'DESIGN_CACHE_VERSION',
+                      circuit_writer.DESIGN_CACHE_VERSION + 1)
+  CircuitWriter(Design()).ReadProtoToDesign(
+      design_proto, cache_dir=str(cache_dir))
+
+  assert len(list(cache_dir.glob('*.pkl'))) == 2
+
+
+def test_read_proto_does_not_cache_unpicklable_designs(
+    design_proto, tmp_path, monkeypatch, caplog):
+  from_circuit_proto = CircuitWriter.FromCircuitProto
+
+  def FromCircuitProtoWithConcat(self, package_pb):
+    from_circuit_proto(self, package_pb)
+    instance = self.design.known_modules['leaf'].instances['n0']
+    instance.connections['A'].concat = object()
+
+  monkeypatch.setattr(
+      CircuitWriter, 'FromCircuitProto', FromCircuitProtoWithConcat)
+  cache_dir = tmp_path / 'cache'
+  design = Design()
+  with caplog.at_level(logging.WARNING, logger='circuit_writer'):
+    CircuitWriter(design).ReadProtoToDesign(
+        design_proto, cache_dir=str(cache_dir))
+
+  assert 'leaf' in design.known_modules
+  assert 'not caching design' in caplog.text
+  assert list(cache_dir.iterdir()) == []
+
+
+def test_to_si_prefix_matches_prefix_map():
+  for prefix, prefix_pb in CircuitWriter.CIRCUIT_TO_PB_SI_PREFIX_MAP.items():
+    assert CircuitWriter.ToSIPrefix(prefix) == prefix_pb
+
+
+@pytest.mark.parametrize('value', [-25, -23, 0, 25, 48])
+def test_to_si_prefix_rejects_unknown_exponents(value):
+  with pytest.raises(Exception, match='Unknown SI prefix'):
+    CircuitWriter.ToSIPrefix(types.SimpleNamespace(value=value))
+
+
+def test_read_proto_cache_keeps_primitive_singletons(design_proto, tmp_path):
+  cache_dir = str(tmp_path / 'cache')
+  CircuitWriter(Design()).ReadProtoToDesign(design_proto, cache_dir=cache_dir)
+  design = Design()
+  CircuitWriter(design).ReadProtoToDesign(design_proto, cache_dir=cache_dir)
+
+  for name, primitive in circuit.PRIMITIVE_MODULES.items():
+    if name in design.external_modules:
+      assert design.external_modules[name] is primitive
+  assert design.external_modules['CAPACITOR'] is circuit.CAPACITOR
+  assert set(design.external_modules) >= {'NAND2', 'INV'}
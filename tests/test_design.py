@@ -0,0 +1,147 @@
+# vim: set shiftwidth=2 softtabstop=2 ts=2 expandtab:
+#
+#    Copyright 2022 Google LLC
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import logging
+
+import pytest
+
+import circuit
+import spef
+from design import Design
+from verilog import DesignReader
+
+
+@pytest.fixture
+def chosen_reader(monkeypatch):
+  chosen = []
+  monkeypatch.setattr(
+      DesignReader, 'ParseVerilog',
+      lambda **kwargs: chosen.append('pyverilog'))
+  monkeypatch.setattr(
+      DesignReader, 'ParseVerilogFast',
+      lambda **kwargs: chosen.append('yosys'))
+  return chosen
+
+
+def test_parse_verilog_uses_pyverilog_by_default(chosen_reader, monkeypatch):
+  monkeypatch.setattr(DesignReader, 'YosysAvailable', lambda: True)
+
+  Design().ParseVerilog(['top.v'], [], [])
+
+  assert chosen_reader == ['pyverilog']
+
+
+def test_parse_verilog_uses_yosys_when_asked(chosen_reader, monkeypatch):
+  monkeypatch.setattr(DesignReader, 'YosysAvailable', lambda: True)
+
+  Design().ParseVerilog(['top.v'], [], [], use_yosys=True)
+
+  assert chosen_reader == ['yosys']
+
+
+def test_parse_verilog_warns_without_yosys(
+    chosen_reader, monkeypatch, caplog):
+  monkeypatch.setattr(DesignReader, 'YosysAvailable', lambda: False)
+
+  with caplog.at_level(logging.WARNING, logger='design'):
+    Design().ParseVerilog(['top.v'], [], [], use_yosys=True)
+
+  assert chosen_reader == ['pyverilog']
+  assert 'yosys not found' in caplog.text
+
+
+def test_link_warns_about_extra_positional_connections(
+    verilog_parser, wrapped_verilog, caplog):
+  source = wrapped_verilog + '''
+module overfull (a, b, y, z);
+  input a;
+  input b;
+  output y;
+  output z;
+  leaf m0 (a, b, y, z);
+endmodule
+'''
+  design = Design()
+  DesignReader.RegisterModules(design, [
+      circuit.Module.FromVerilog(node)
+      for node in DesignReader.WalkModuleDefs(verilog_parser(source))])
+
+  with caplog.at_level(logging.WARNING, logger='design'):
+    design.Link()
+
+  assert set(design.known_modules['overfull'].instances['m0'].connections) == {
+      'a', 'b', 'y'}
+  assert 'instance m0 of module leaf has too many connections' in caplog.text
+  assert 'known ports: a, b, y' in caplog.text
+
+
+def test_merge_spef_prunes_signals_left_unconnected(verilog_parser):
+  source = '''
+module leaf (a, b, y);
+  input a;
+  input b;
+  output y;
+  wire nand_out;
+  wire dangling;
+  wire VDD;
+  NAND2 n0 (.A(a), .B(b), .Y(nand_out));
+  INV i0 (.A(nand_out), .Y(y));
+endmodule
+'''
+  design = Design()
+  DesignReader.RegisterModules(design, [
+      circuit.Module.FromVerilog(node)
+      for node in DesignReader.WalkModuleDefs(verilog_parser(source))])
+  design.Link()
+  leaf = design.known_modules['leaf']
+
+  # The extracted netlist moves the NAND output onto a net of its own.
+  spef_module = circuit.Module()
+  spef_module.name = 'leaf'
+  extracted = spef_module.GetOrCreateSignal('nand_out_ext')
+  for instance_name, module_name, port_name in (
+      ('n0', 'NAND2', 'Y'), ('i0', 'INV', 'A')):
+    instance = circuit.Instance()
+    instance.name = instance_name
+    instance.module_name = module_name
+    connection = circuit.Connection(port_name)
+    connection.signal = extracted
+    connection.instance = instance
+    instance.connections[port_name] = connection
+    spef_module.instances[instance_name] = instance
+
+  design.MergeSPEFIntoVerilogModule(leaf, spef_module)
+
+  # nand_out and dangling connect nothing and are pruned. Power nets are never
+  # expected in SPEF, so VDD stays.
+  assert set(leaf.signals) == {'a', 'b', 'y', 'nand_out_ext', 'VDD'}
+  assert leaf.instances['i0'].connections['A'].signal.name == 'nand_out_ext'
+
+
+def test_merge_spef_rejects_signals_of_different_widths(
+    verilog_parser, wrapped_verilog):
+  design = Design()
+  DesignReader.RegisterModules(design, [
+      circuit.Module.FromVerilog(node)
+      for node in DesignReader.WalkModuleDefs(
+          verilog_parser(wrapped_verilog))])
+  spef_module = circuit.Module()
+  spef_module.name = 'leaf'
+  spef_module.GetOrCreateSignal('nand_out').width = 2
+
+  with pytest.raises(spef.SPEFBadAssumption, match='different width 2 vs 1'):
+    design.MergeSPEFIntoVerilogModule(
+        design.known_modules['leaf'], spef_module)
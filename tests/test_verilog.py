@@ -0,0 +1,227 @@
+# vim: set shiftwidth=2 softtabstop=2 ts=2 expandtab:
+#
+#    Copyright 2022 Google LLC
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import concurrent.futures
+import threading
+
+import pytest
+
+import circuit
+import verilog
+from design import Design
+from verilog import DesignReader
+
+
+def test_build_modules_in_parallel_matches_serial(
+    verilog_parser, wrapped_verilog, summarise_module):
+  args = [(node,) for node in
+          DesignReader.WalkModuleDefs(verilog_parser(wrapped_verilog))]
+
+  serial = DesignReader.BuildModules(circuit.Module.FromVerilog, args, jobs=1)
+  parallel = DesignReader.BuildModules(circuit.Module.FromVerilog, args, jobs=3)
+
+  assert ([summarise_module(module) for module in parallel] ==
+          [summarise_module(module) for module in serial])
+
+
+def test_build_modules_does_not_fork_with_threads_running(
+    verilog_parser, wrapped_verilog, summarise_module, monkeypatch):
+  args = [(node,) for node in
+          DesignReader.WalkModuleDefs(verilog_parser(wrapped_verilog))]
+  start_methods = []
+  executor_type = concurrent.futures.ProcessPoolExecutor
+
+  def RecordingExecutor(*args, mp_context=None, **kwargs):
+    start_methods.append(mp_context.get_start_method())
+    return executor_type(*args, mp_context=mp_context, **kwargs)
+
+  monkeypatch.setattr(
+      verilog.concurrent.futures, 'ProcessPoolExecutor', RecordingExecutor)
+
+  stop = threading.Event()
+  thread = threading.Thread(target=stop.wait)
+  thread.start()
+  try:
+    parallel = DesignReader.BuildModules(
+        circuit.Module.FromVerilog, args, jobs=2)
+  finally:
+    stop.set()
+    thread.join()
+
+  assert start_methods and start_methods[0] != 'fork'
+  serial = DesignReader.BuildModules(circuit.Module.FromVerilog, args, jobs=1)
+  assert ([summarise_module(module) for module in parallel] ==
+          [summarise_module(module) for module in serial])
+
+
+def test_parse_verilog_with_jobs_links_modules(
+    verilog_parser, wrapped_verilog, tmp_path, monkeypatch):
+  verilog_file = tmp_path / 'wrapped.v'
+  verilog_file.write_text(wrapped_verilog)
+  monkeypatch.setattr(
+      DesignReader, 'ParseWithPyverilog',
+      lambda files, includes, defines: verilog_parser(
+          ''.join(open(f).read() for f in files)))
+
+  design = Design()
+  design.ParseVerilog([str(verilog_file)], [], [], jobs=3)
+  design.Link()
+
+  leaf = design.known_modules['leaf']
+  wrapper = design.known_modules['wrapper']
+  assert wrapper.instances['m0'].module is leaf
+  assert set(leaf.instances) == {'n0', 'i0'}
+
+
+def test_link_connects_positional_arguments(verilog_parser, wrapped_verilog):
+  source = wrapped_verilog + '''
+module bus_wrapper (bus, y);
+  input [1:0] bus;
+  output y;
+  leaf m0 (bus[0], bus[1], y);
+endmodule
+'''
+  design = Design()
+  DesignReader.RegisterModules(design, [
+      circuit.Module.FromVerilog(node)
+      for node in DesignReader.WalkModuleDefs(verilog_parser(source))])
+  design.Link()
+
+  for name in ('wrapper', 'bus_wrapper'):
+    module = design.known_modules[name]
+    connections = module.instances['m0'].connections
+    assert set(connections) == {'a', 'b', 'y'}
+    for connection in connections.values():
+      assert connection in (connection.signal or connection.slice).Connects()
+
+  connections = design.known_modules['bus_wrapper'].instances['m0'].connections
+  assert (connections['b'].slice.signal.name, connections['b'].slice.top,
+          connections['b'].slice.bottom) == ('bus', 1, 1)
+
+
+def counting_parse(calls):
+  def parse(verilog_files, include_paths, defines):
+    calls.append(list(defines))
+    return len(calls)
+  return parse
+
+
+def test_cached_parse_reuses_result(tmp_path):
+  (tmp_path / 'top.v').write_text('module top; endmodule\n')
+  calls = []
+  parse = counting_parse(calls)
+
+  for _ in range(2):
+    result = verilog.CachedParse(
+        'test', parse, lambda: '1', tmp_path / 'cache',
+        [str(tmp_path / 'top.v')], [], [])
+
+  assert result == 1
+  assert len(calls) == 1
+
+
+def test_cached_parse_sees_included_files(tmp_path):
+  (tmp_path / 'inc').mkdir()
+  (tmp_path / 'top.v').write_text('`include "cells.vh"\n')
+  (tmp_path / 'inc' / 'cells.vh').write_text('`include "more.vh"\n')
+  more = tmp_path / 'inc' / 'more.vh'
+  more.write_text('// one\n')
+  calls = []
+  parse = counting_parse(calls)
+
+  def Parse():
+    return verilog.CachedParse(
+        'test', parse, lambda: '1', tmp_path / 'cache',
+        [str(tmp_path / 'top.v')], [tmp_path / 'inc'], [])
+
+  Parse()
+  Parse()
+  more.write_text('// two\n')
+  Parse()
+
+  assert len(calls) == 2
+
+
+def test_cached_parse_keys_on_defines_and_version(tmp_path):
+  (tmp_path / 'top.v').write_text('module top; endmodule\n')
+  calls = []
+  parse = counting_parse(calls)
+
+  def Parse(defines, version):
+    verilog.CachedParse(
+        'test', parse, lambda: version, tmp_path / 'cache',
+        [str(tmp_path / 'top.v')], [], defines)
+
+  Parse(['A=1'], '1')
+  Parse(['A=2'], '1')
+  Parse(['A=2'], '2')
+  Parse(['A=1'], '1')
+
+  assert calls == [['A=1'], ['A=2'], ['A=2']]
+
+
+def test_register_modules_resolves_earlier_references(
+    verilog_parser, wrapped_verilog):
+  leaf, wrapper = [
+      circuit.Module.FromVerilog(node)
+      for node in DesignReader.WalkModuleDefs(verilog_parser(wrapped_verilog))]
+  design = Design()
+
+  # wrapper refers to leaf before leaf is known.
+  DesignReader.RegisterModules(design, [wrapper])
+  assert 'leaf' in design.unknown_references
+  DesignReader.RegisterModules(design, [leaf])
+
+  assert set(design.known_modules) == {'leaf', 'wrapper'}
+  assert set(design.unknown_references) == {'NAND2', 'INV'}
+
+
+def test_cached_parse_replaces_damaged_entries(tmp_path):
+  (tmp_path / 'top.v').write_text('module top; endmodule\n')
+  cache_dir = tmp_path / 'cache'
+  calls = []
+  parse = counting_parse(calls)
+
+  def Parse():
+    return verilog.CachedParse(
+        'test', parse, lambda: '1', cache_dir,
+        [str(tmp_path / 'top.v')], [], [])
+
+  Parse()
+  (entry,) = cache_dir.iterdir()
+  entry.write_bytes(entry.read_bytes()[:3])
+
+  assert Parse() == 2
+  assert Parse() == 2
+  assert len(calls) == 2
+  assert list(cache_dir.iterdir()) == [entry]
+
+
+def test_cached_parse_leaves_nothing_behind_when_writing_fails(
+    tmp_path, monkeypatch):
+  (tmp_path / 'top.v').write_text('module top; endmodule\n')
+  cache_dir = tmp_path / 'cache'
+
+  def FailingDump(*args, **kwargs):
+    raise RecursionError('maximum recursion depth exceeded')
+
+  monkeypatch.setattr(verilog.pickle, 'dump', FailingDump)
+  with pytest.raises(RecursionError):
+    verilog.CachedParse(
+        'test', counting_parse([]), lambda: '1', cache_dir,
+        [str(tmp_path / 'top.v')], [], [])
+
+  assert list(cache_dir.iterdir()) == []
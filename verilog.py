@@ -6,6 +6,19 @@ via `pyverilog.vparser.ast`, transforming its AST nodes into `Design` and `Modul
 from typing import List 
 from pathlib import Path 
 from warnings import warn 
+import concurrent.futures
+import hashlib
+import importlib.metadata
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 
 from pyverilog.vparser import parser as verilog_parser
 import pyverilog.vparser.ast as ast
@@ -13,6 +26,20 @@ import pyverilog.vparser.ast as ast
 # Local Imports 
 from circuit import Module, VerilogIdentifier, Port, Instance, Connection, Slice
 
+# The Yosys binary used by the fast Verilog frontend.
+YOSYS_BINARY = 'yosys'
+
+# Bump this when the pickled parser output changes shape, so that CachedParse
+# stops handing out stale entries.
+CACHE_VERSION = 1
+
+# Matches `include "file" directives.
+INCLUDE_RE = re.compile(rb'`include\s+"([^"]+)"')
+
+# The (build, args) pair given to each of BuildModules' worker processes when
+# it starts.
+WORKER_BUILD = None
+
 
 class DesignReader:
   """ Read Verilog into a `Design`. 
@@ -25,39 +52,229 @@ class DesignReader:
       design: "Design", 
       verilog_files: List[Path], 
       include_paths: List[Path], 
-      defines: List[Path]
+      defines: List[Path],
+      cache_dir: Path = None,
+      jobs: int = 1
     ):
+    first = CachedParse(
+        'pyverilog', DesignReader.ParseWithPyverilog,
+        DesignReader.PyverilogVersion, cache_dir,
+        verilog_files, include_paths, defines)
+    # 'first' is a pyverilog.vparser.ast.Node
+    # Circuit.Module will read the node and its children to parse the Verilog.
+    modules = DesignReader.BuildModules(
+        Module.FromVerilog,
+        [(node,) for node in DesignReader.WalkModuleDefs(first)],
+        jobs)
+
+    DesignReader.RegisterModules(design, modules)
+
+  @staticmethod
+  def WalkModuleDefs(node):
+    """Yields the ModuleDefs under node, in source order.
+
+    Modules don't nest in Verilog, so there's no need to descend into one.
+    """
+    if isinstance(node, ast.ModuleDef):
+      yield node
+      return
+    for child in node.children():
+      yield from DesignReader.WalkModuleDefs(child)
+
+  @staticmethod
+  def ParseWithPyverilog(verilog_files, include_paths, defines):
     first, directives = verilog_parser.parse(verilog_files,
                                              preprocess_include=include_paths,
                                              preprocess_define=defines)
-    # 'first' is a pyverilog.vparser.ast.Node
-    queue = [first]
-    modules = []
-    while queue:
-      node = queue.pop()
-      if isinstance(node, ast.ModuleDef):
-        # Circuit.Module will read the node and its children to parse the
-        # Verilog.
-        module = Module.FromVerilog(node)
-        modules.append(module)
-      #if node.attr_names:
-      #  for attr in node.attr_names:
-      #    print('attr: {}={}'.format(attr, getattr(node, attr)))
-      for c in node.children():
-        queue.append(c)
+    return first
+
+  @staticmethod
+  def PyverilogVersion() -> str:
+    return importlib.metadata.version('pyverilog')
+
+  @staticmethod
+  def YosysVersion() -> str:
+    return subprocess.run([YOSYS_BINARY, '-V'], check=True,
+                          capture_output=True, text=True).stdout.strip()
 
+  @staticmethod
+  def YosysAvailable() -> bool:
+    return shutil.which(YOSYS_BINARY) is not None
+
+  @staticmethod
+  def ParseVerilogFast(
+      design: "Design", 
+      verilog_files: List[Path], 
+      include_paths: List[Path], 
+      defines: List[Path],
+      cache_dir: Path = None,
+      jobs: int = 1
+    ):
+    """ Parse Verilog with Yosys instead of pyverilog.
+
+    Yosys reads the files and dumps its netlist as JSON, which we walk
+    directly. This is much faster than pyverilog's parser on large gate-level
+    netlists. """
+    netlist = CachedParse(
+        'yosys', DesignReader.ParseWithYosys,
+        DesignReader.YosysVersion, cache_dir,
+        verilog_files, include_paths, defines)
+    modules = DesignReader.BuildModules(
+        Module.FromYosysJSON, list(netlist.get('modules', {}).items()), jobs)
+    DesignReader.RegisterModules(design, modules)
+
+  @staticmethod
+  def ParseWithYosys(verilog_files, include_paths, defines):
+    read_args = ['-noopt']
+    read_args.extend(f'-I"{path}"' for path in include_paths)
+    read_args.extend(f'-D{define}' for define in defines)
+    read_args.extend(f'"{path}"' for path in verilog_files)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+      json_file = os.path.join(temp_dir, 'netlist.json')
+      script = f'read_verilog {" ".join(read_args)}; write_json "{json_file}"'
+      subprocess.run([YOSYS_BINARY, '-q', '-p', script], check=True)
+      with open(json_file) as f:
+        return json.load(f)
+
+  @staticmethod
+  def BuildModules(build, args, jobs=1):
+    """ Return [build(*a) for a in args], using 'jobs' worker processes.
+
+    Modules are read independently of one another, so they can be built in
+    parallel. Each worker is handed (build, args) once, by its initializer, and
+    only indices into args and the finished Modules travel between processes
+    after that. Registration with the design stays in the caller, in order.
+
+    Workers are forked when this is the only thread, so that they inherit the
+    parser output instead of having it pickled to them. Forking a process
+    with other threads running (like the SPEF readers' process pool) can leave
+    the child holding locks that will never be released, so otherwise the
+    workers are started fresh. """
+    if jobs <= 1 or len(args) <= 1:
+      return [build(*a) for a in args]
+
+    start_methods = multiprocessing.get_all_start_methods()
+    if 'fork' in start_methods and threading.active_count() == 1:
+      context = multiprocessing.get_context('fork')
+    elif 'forkserver' in start_methods:
+      context = multiprocessing.get_context('forkserver')
+    else:
+      context = multiprocessing.get_context('spawn')
+
+    jobs = min(jobs, len(args))
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, mp_context=context, initializer=InitBuildWorker,
+        initargs=(build, args)) as executor:
+      return list(executor.map(
+          BuildInWorker, range(len(args)),
+          chunksize=max(1, len(args) // (4 * jobs))))
+
+  @staticmethod
+  def RegisterModules(design: "Design", modules: List[Module]):
     # Tidy up references made to other modules.
+    known_modules = design.known_modules
+    unknown_references = design.unknown_references
     for module in modules:
       name = module.name
-      if name in design.known_modules:
+      if name in known_modules:
         raise Exception('duplicate definition of {}'.format(name))
-      design.known_modules[module.name] = module
-      if name in design.unknown_references:
-        design.unknown_references.remove(name)
+      known_modules[name] = module
       # Maybe we referenced it already.
-      for _, instance in module.instances.items():
-        if instance.module_name not in design.known_modules:
-          design.unknown_references[instance.module_name].append(instance)
+      unknown_references.pop(name, None)
+      # Group this module's unresolved instances by the module they reference
+      # so that unknown_references is touched once per distinct reference.
+      unknown_here = {}
+      for instance in module.instances.values():
+        module_name = instance.module_name
+        if module_name not in known_modules:
+          unknown_here.setdefault(module_name, []).append(instance)
+      for module_name, instances in unknown_here.items():
+        unknown_references[module_name].extend(instances)
+
+
+def InitBuildWorker(build, args):
+  global WORKER_BUILD
+  WORKER_BUILD = (build, args)
+
+
+def BuildInWorker(index):
+  build, args = WORKER_BUILD
+  return build(*args[index])
+
+
+def HashVerilogFile(key, file_name, include_paths, seen):
+  """ Add file_name, and every file it `includes, to the hash 'key'.
+
+  Includes are found by scanning for the directive rather than by
+  preprocessing, so one inside an `ifdef counts whether or not it is used;
+  that can only cost a cache miss. An include we can't find is hashed by
+  name. """
+  file_name = os.path.abspath(file_name)
+  if file_name in seen:
+    return
+  seen.add(file_name)
+  with open(file_name, 'rb') as f:
+    contents = f.read()
+  key.update(file_name.encode() + b'\0')
+  key.update(hashlib.blake2b(contents).digest())
+
+  search = [os.path.dirname(file_name)] + [str(p) for p in include_paths]
+  for match in INCLUDE_RE.finditer(contents):
+    name = os.fsdecode(match.group(1))
+    for directory in search:
+      candidate = os.path.join(directory, name)
+      if os.path.isfile(candidate):
+        HashVerilogFile(key, candidate, include_paths, seen)
+        break
+    else:
+      key.update(b'missing\0' + match.group(1) + b'\0')
+
+
+def CachedParse(kind, parse, version, cache_dir, verilog_files, include_paths,
+                defines):
+  """ Return parse(verilog_files, include_paths, defines), memoised on disk.
+
+  Parsing is deterministic in the file contents (including `included files),
+  the include/define set and the parser, so the parser's output is pickled
+  into 'cache_dir' under a hash of those inputs. 'version' returns the
+  parser's version and is only called when caching. We cache the parser output
+  (a tree) rather than the resulting Modules, since those change whenever the
+  readers do. """
+  if cache_dir is None:
+    return parse(verilog_files, include_paths, defines)
+
+  key = hashlib.blake2b(kind.encode())
+  for item in [CACHE_VERSION, pickle.HIGHEST_PROTOCOL, version()]:
+    key.update(str(item).encode() + b'\0')
+  seen = set()
+  for file_name in sorted(verilog_files):
+    HashVerilogFile(key, file_name, include_paths, seen)
+  for item in sorted(map(str, include_paths)) + ['-D'] + sorted(defines):
+    key.update(item.encode() + b'\0')
+
+  os.makedirs(cache_dir, exist_ok=True)
+  cache_file = os.path.join(cache_dir, f'{key.hexdigest()}.pkl')
+  if os.path.exists(cache_file):
+    try:
+      with open(cache_file, 'rb') as f:
+        return pickle.load(f)
+    except (pickle.UnpicklingError, EOFError):
+      # A damaged entry is just a miss; it is replaced below.
+      pass
+
+  result = parse(verilog_files, include_paths, defines)
+  # Write to a temporary file first so that an interrupted or failed write
+  # never leaves a truncated entry behind.
+  fd, temp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file, cache_file)
+  except:
+    os.remove(temp_file)
+    raise
+  return result
 
 
 class ModuleReader:
@@ -170,34 +387,45 @@ class ModuleReader:
     for ast_instance in ast_instancelist.instances:
       instance = Instance()
       instance.name = VerilogIdentifier(ast_instance.name).raw
-      instance.module_name = VerilogIdentifier(ast_instance.module).raw
+      instance.module_name = sys.intern(
+          VerilogIdentifier(ast_instance.module).raw)
       if not ast_instance.portlist:
         #print('skipping instance without connections: {}'.format(instance))
         del instance
         continue
       for ast_portarg in ast_instance.portlist:
         # These are connections.
-        port_name = ast_portarg.portname
-        connection = Connection(port_name)
-        connection.instance = instance
         children = ast_portarg.children()
         if len(children) > 1:
           raise NotImplementedError('can\'t deal with portargs that have many children')
         identifier = children[0]
+        target = None
         if isinstance(identifier, ast.Identifier):
           net_name = VerilogIdentifier(identifier.name).raw
-          signal = module.signals[net_name]
-          connection.signal = signal
-          signal.Connect(connection)
+          target = module.signals[net_name]
         elif isinstance(identifier, ast.Pointer):
           net_name = VerilogIdentifier(identifier.var.name).raw
-          net_slice = Slice()
-          signal = module.signals[net_name]
-          net_slice.signal = signal
-          net_slice.top = int(identifier.ptr.value)
-          net_slice.bottom = int(identifier.ptr.value)
-          net_slice.Connect(connection)
-          connection.slice = net_slice
+          target = Slice()
+          target.signal = module.signals[net_name]
+          target.top = int(identifier.ptr.value)
+          target.bottom = int(identifier.ptr.value)
+
+        port_name = ast_portarg.portname
+        if port_name is None:
+          # A positional argument. Which port it connects to depends on the
+          # master's port order, so Design.Link makes the Connection once the
+          # master is known.
+          instance.connections_by_order.append(target)
+          continue
+
+        connection = Connection(port_name)
+        connection.instance = instance
+        if isinstance(target, Slice):
+          connection.slice = target
+        else:
+          connection.signal = target
+        if target is not None:
+          target.Connect(connection)
         instance.connections[port_name] = connection
       module.instances[instance.name] = instance
 
@@ -205,3 +433,100 @@ class ModuleReader:
     if len(ast_node.children()):
         print('{} has a param list, which we ignore'.format(module))
 
+
+
+class YosysModuleReader:
+  """ Read a module from Yosys' JSON netlist format into a `Module`.
+
+  This is experimental and only used when asked for (Design.ParseVerilog's
+  use_yosys). Instance ports connected by position, `assign` statements (which
+  become Yosys internal cells), constant or concatenated connections and bus
+  offsets are not handled the way the pyverilog reader handles them.
+
+  Not really a class in the sense of having instances, but more a namespace 
+  for associated static methods. """
+
+  DIRECTION_MAP = {
+      'input': Port.Direction.INPUT,
+      'output': Port.Direction.OUTPUT,
+      'inout': Port.Direction.INOUT,
+  }
+
+  @staticmethod
+  def LoadJSON(module: Module, name: str, json_module: dict):
+    module.name = VerilogIdentifier(name).raw
+
+    # Yosys numbers every bit in the module. Map each bit number back to the
+    # (signal, index) it belongs to so that cell connections can be resolved.
+    # Ports are mapped first so that they win when a bit has several names.
+    bit_to_wire = {}
+    for port_name, json_port in json_module.get('ports', {}).items():
+      bits = json_port['bits']
+      direction = YosysModuleReader.DIRECTION_MAP.get(
+          json_port.get('direction'), Port.Direction.NONE)
+      port = module.GetOrCreatePort(
+          VerilogIdentifier(port_name).raw, width=len(bits), direction=direction)
+      YosysModuleReader.MapBits(bit_to_wire, port.signal, bits)
+
+    for net_name, json_net in json_module.get('netnames', {}).items():
+      if json_net.get('hide_name'):
+        # Names Yosys made up itself.
+        continue
+      name = VerilogIdentifier(net_name).raw
+      if name in module.ports:
+        continue
+      bits = json_net['bits']
+      signal = module.GetOrCreateSignal(name, width=len(bits))
+      YosysModuleReader.MapBits(bit_to_wire, signal, bits)
+
+    for cell_name, json_cell in json_module.get('cells', {}).items():
+      cell_type = json_cell['type']
+      if cell_type.startswith('$'):
+        raise NotImplementedError(
+            f'Yosys internal cell {cell_name} of type {cell_type}; only '
+            'structural netlists are supported')
+      connections = json_cell.get('connections')
+      if not connections:
+        continue
+      instance = Instance()
+      instance.name = VerilogIdentifier(cell_name).raw
+      instance.module_name = sys.intern(VerilogIdentifier(cell_type).raw)
+      for port_name, bits in connections.items():
+        connection = Connection(port_name)
+        connection.instance = instance
+        YosysModuleReader.ConnectBits(connection, bit_to_wire, bits)
+        instance.connections[port_name] = connection
+      module.instances[instance.name] = instance
+
+  @staticmethod
+  def MapBits(bit_to_wire: dict, signal, bits: list):
+    # Indices are positions in the bit list, LSB first, which is how
+    # Signal.width is interpreted everywhere else.
+    for index, bit in enumerate(bits):
+      if isinstance(bit, int):
+        bit_to_wire.setdefault(bit, (signal, index))
+
+  @staticmethod
+  def ConnectBits(connection: Connection, bit_to_wire: dict, bits: list):
+    wires = [bit_to_wire.get(bit) for bit in bits]
+    if not wires or None in wires:
+      # Constant ("0", "1", "x", "z") or unnamed bits. Like the pyverilog
+      # reader, we leave these disconnected.
+      warn(f'leaving connection with constant or unknown bits disconnected: '
+           f'{connection} {bits}')
+      return
+    signal, bottom = wires[0]
+    top = bottom + len(wires) - 1
+    if any(wire != (signal, bottom + i) for i, wire in enumerate(wires)):
+      raise NotImplementedError(
+          f'can\'t deal with connections to concatenated signals: {bits}')
+    if bottom == 0 and len(wires) == signal.width:
+      connection.signal = signal
+      signal.Connect(connection)
+      return
+    net_slice = Slice()
+    net_slice.signal = signal
+    net_slice.top = top
+    net_slice.bottom = bottom
+    net_slice.Connect(connection)
+    connection.slice = net_slice